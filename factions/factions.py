@@ -1,86 +1,411 @@
+import discord
 from discord.ext import commands
 from .utils import checks
 from __main__ import send_cmd_help
 from cogs.utils.dataIO import dataIO
 from .utils.chat_formatting import box, pagify
+import aiohttp
+import asyncio
+import bisect
+import csv
+import io
+import json
 import logging
 import os
 import re
-from typing import Union, List
+import time
+from collections import ChainMap, Counter, defaultdict
+from datetime import datetime
+from typing import Union, List, Optional
 
 try:
     from tabulate import tabulate
 except Exception as e:
     raise RuntimeError("You must run `pip3 install tabulate`.") from e
 
-FILE_PATH = "data/factions/settings.json"
+FILE_PATH = "data/factions/settings.json"  # all servers in one file, before sharding
+SERVER_PATH = "data/factions/servers/{}.json"
+LEDGER_PATH = "data/factions/ledgers/{}.jsonl"
+DAY = 60 * 60 * 24
+DAY_ROLLUPS = 92  # days of daily totals kept
+WEEK_ROLLUPS = 104  # weeks of weekly totals kept
+IDLE_TIMEOUT = 600  # seconds a server's data stays loaded once unused
+ACTIVITY_PATH = "data/factions/activity.json"  # activity settings of every server, read on every message
+FLUSH_INTERVAL = 60  # seconds between two saves of activity points
+FUZZY_CUTOFF = 0.5  # trigram similarity a close match needs, from 0 to 1
+PAGE_SIZE = 20  # factions per page of checkall
+NEIGHBOURS = 2  # factions shown above and below by rank
 log = logging.getLogger('red.factions')
 logging.basicConfig(format='%(asctime)s,%(msecs)d %(levelname)-8s [%(filename)s:%(lineno)d] %(message)s',
                     datefmt='%d-%m-%Y:%H:%M:%S')
 
 default_language = {
+    "activity_off": "Members no longer earn <point_name> for chatting.",
+    "activity_on": "Members now earn <point_name> for chatting.",
+    "activity_rate": "Members now earn <points> <point_name> per message, at most every <cooldown> seconds.",
+    "activity_role": "Members with the <role> role now earn <point_name> for <faction_name>.",
+    "activity_role_none": "Members with the <role> role no longer earn <point_name>.",
     "alias_delete": "Alias deleted.",
     "alias_new": "Alias added.",
     "alias_none": "There are no aliases on this server, use <prefix>points alias new to add a new alias.",
     "alias_no_exists": "The alias <alias> doesn't exist.",
+    "bulk_bad": "Nothing was changed, these entries are invalid:",
+    "bulk_none": "No entries given, use <prefix>points bulk with a \"faction points\" entry per line, or attach a CSV file.",
+    "bulk_done": "Done, <count> faction(s) updated.",
+    "cooldown_bad": "The cooldown can't be negative.",
     "confirm_reset": "This will clear the <point_name> for every faction. Type \"yes\" to continue.",
     "faction_create": "Faction created.",
     "faction_delete": "Faction deleted.",
     "faction_exists": "There is already a faction named <faction_name>.",
     "faction_no_exists": "The faction <faction_name> doesn't exist.",
     "faction_none": "There are no factions on this server, use <prefix>points create to add a new faction.",
+    "history_faction": "<faction_name> changed by <points> <point_name> in that window.",
+    "history_none": "<faction_name> has no <point_name> changes in that window.",
     "lang_no_line": "No line named <lang_name> in language.",
+    "lang_bad_placeholder": "<lang_name> can't use <placeholder>, it can use <allowed>.",
     "lang_reset": "Language reset to default.",
     "point_name": "point",
+    "period_bad": "Unknown window <period>, use today, week, or a number of days or weeks like 7d or 4w.",
     "points_added": "Added <points> <point_name> to <faction_name>, they now have <new_points>.",
     "points_bad": "The <point_name> value must be greater than zero.",
     "points_faction": "<faction_name> has <points> <point_name>.",
     "points_removed": "Removed <points> <point_name> from <faction_name>, they now have <new_points>.",
     "points_set": "The faction <faction_name> now has <points> <point_name>.",
+    "page_no_exists": "There is no page <page>, there are <pages>.",
+    "rank_faction": "<faction_name> is ranked #<rank> of <count> with <points> <point_name>.",
     "points_zero": "Can't remove any more <point_name> from <faction_name>, they are already at zero.",
     "reset_no": "Okay, <point_name> will not be reset.",
     "reset_yes": "Reset <point_name>.",
     "suffix": "s",
     #  Special cases, each are used as the headers for tabulations of their respective values.
     "AliasActual": "Alias Actual",
+    "DayChange": "Day Change",
     "Faction": "Faction",
+    "FactionChangeTotal": "Faction Change Total",
     "NameValue": "Name Value",
+    "Rank": "Rank",
 }
 
+PLACEHOLDER = re.compile(r"<(.+?)>")
+
+
+def _allowed_placeholders(key: str) -> set:
+    """Returns the placeholders a language line may use"""
+    if key in ("point_name", "suffix"):
+        return set()
+    return set(PLACEHOLDER.findall(default_language[key])) | {"point_name", "suffix"}
+
+
+def _compile_line(key: str, line: str, point_name: str, suffix: str, plural: bool) -> str:
+    """Compiles a language line into a str.format template.
+
+    The point name and suffix are baked in, other allowed placeholders become
+    format fields, and anything else is left as it is."""
+    if plural:
+        line = line.replace("<point_name>", "<point_name><suffix>")
+    allowed = _allowed_placeholders(key)
+    constants = {"point_name": point_name, "suffix": suffix}
+
+    def escape(text):
+        return text.replace("{", "{{").replace("}", "}}")
+
+    parts = []
+    position = 0
+    for match in PLACEHOLDER.finditer(line):
+        name = match.group(1)
+        parts.append(escape(line[position:match.start()]))
+        if name not in allowed:
+            parts.append(escape(match.group(0)))
+        elif name in constants:
+            parts.append(escape(constants[name]))
+        else:
+            parts.append("{%s}" % name)
+        position = match.end()
+    parts.append(escape(line[position:]))
+    return "".join(parts)
+
+
+class Leaderboard:
+    """Factions of a server kept sorted by points, most first.
+
+    Holds (-points, name) keys in a sorted list, so updates and rank
+    lookups are a bisection rather than a sort of every faction."""
+
+    def __init__(self, factions: dict):
+        self.points = dict(factions)
+        self.keys = sorted((-p, name) for name, p in factions.items())
+
+    def __len__(self):
+        return len(self.keys)
+
+    def update(self, name: str, points: int):
+        if name in self.points:
+            self.remove(name)
+        self.points[name] = points
+        bisect.insort(self.keys, (-points, name))
+
+    def remove(self, name: str):
+        key = (-self.points.pop(name), name)
+        del self.keys[bisect.bisect_left(self.keys, key)]
+
+    def rank(self, name: str) -> int:
+        """Returns the 1-based rank of a faction, tied factions sharing a rank"""
+        return bisect.bisect_left(self.keys, (-self.points[name],)) + 1
+
+    def top(self, count: int, start: int=0) -> List[tuple]:
+        """Returns (rank, name, points) from the start-th faction on"""
+        return [(self.rank(name), name, -points) for points, name in self.keys[start:start + count]]
+
+    def neighbours(self, name: str, count: int=NEIGHBOURS) -> List[tuple]:
+        """Returns (rank, name, points) of a faction and those around it"""
+        index = bisect.bisect_left(self.keys, (-self.points[name], name))
+        start = max(index - count, 0)
+        return self.top(index + count + 1 - start, start)
+
+
+def _day(timestamp: float) -> int:
+    return int(timestamp // DAY)
+
+
+def _week(day: int) -> int:
+    # Day 0 is a Thursday, weeks start on Mondays
+    return (day + 3) // 7
+
+
+def _parse_period(period: str, today: int) -> tuple:
+    """Returns the rollup ("day" or "week") and buckets a window covers"""
+    period = period.lower()
+    if period == "today":
+        return "day", range(today, today + 1)
+    elif period == "week":
+        return "week", range(_week(today), _week(today) + 1)
+    match = re.fullmatch(r"(\d+)([dw])", period)
+    if not match:
+        raise ValueError("Unknown window %s" % period)
+    count = int(match.group(1))
+    if match.group(2) == "d" and 0 < count <= DAY_ROLLUPS:
+        return "day", range(today - count + 1, today + 1)
+    elif match.group(2) == "w" and 0 < count <= WEEK_ROLLUPS:
+        return "week", range(_week(today) - count + 1, _week(today) + 1)
+    raise ValueError("Window %s is too long" % period)
+
+
+def _trigrams(text: str) -> set:
+    text = "  %s " % text
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+class NameIndex:
+    """Resolves faction names from their aliases, exactly, by prefix or by close match.
+
+    Aliases are kept in a prefix trie whose nodes count the aliases of each
+    faction below them, and in a trigram index for close matches."""
+
+    def __init__(self, aliases: dict):
+        self.aliases = {}
+        self.trie = ({}, Counter())  # (children, aliases per faction)
+        self.trigrams = defaultdict(set)
+        self.sizes = {}  # alias: number of trigrams
+        for alias, faction in aliases.items():
+            self.add(alias, faction)
+
+    def add(self, alias: str, faction: str):
+        alias = alias.lower()
+        if alias in self.aliases:
+            self.remove(alias)
+        self.aliases[alias] = faction
+        node = self.trie
+        node[1][faction] += 1
+        for char in alias:
+            node = node[0].setdefault(char, ({}, Counter()))
+            node[1][faction] += 1
+        trigrams = _trigrams(alias)
+        self.sizes[alias] = len(trigrams)
+        for trigram in trigrams:
+            self.trigrams[trigram].add(alias)
+
+    def remove(self, alias: str):
+        alias = alias.lower()
+        faction = self.aliases.pop(alias)
+        del self.sizes[alias]
+        nodes = [self.trie]
+        for char in alias:
+            nodes.append(nodes[-1][0][char])
+        for node in nodes:
+            node[1][faction] -= 1
+            if not node[1][faction]:
+                del node[1][faction]
+        # Prune the nodes no alias goes through anymore
+        for depth in range(len(alias), 0, -1):
+            if nodes[depth][1]:
+                break
+            del nodes[depth - 1][0][alias[depth - 1]]
+        for trigram in _trigrams(alias):
+            self.trigrams[trigram].discard(alias)
+            if not self.trigrams[trigram]:
+                del self.trigrams[trigram]
+
+    def remove_faction(self, faction: str):
+        for alias in [a for a, f in self.aliases.items() if f == faction]:
+            self.remove(alias)
+
+    def resolve(self, name: str) -> Optional[str]:
+        """Returns the faction a name stands for, None if unknown or ambiguous"""
+        name = name.lower()
+        if name in self.aliases:
+            return self.aliases[name]
+        node = self.trie
+        for char in name:
+            node = node[0].get(char)
+            if node is None:
+                break
+        else:
+            if len(node[1]) == 1:
+                return next(iter(node[1]))
+            elif node[1]:
+                return None  # prefix of several factions, guessing could pick the wrong one
+
+        trigrams = _trigrams(name)
+        shared = Counter(alias for trigram in trigrams for alias in self.trigrams.get(trigram, ()))
+        scores = {}
+        for alias, count in shared.items():
+            score = 2 * count / (len(trigrams) + self.sizes[alias])
+            faction = self.aliases[alias]
+            scores[faction] = max(score, scores.get(faction, 0))
+        best = sorted(scores.items(), key=lambda fs: fs[1], reverse=True)[:2]
+        if best and best[0][1] >= FUZZY_CUTOFF and (len(best) == 1 or best[1][1] < best[0][1]):
+            return best[0][0]
+        return None
+
+
+class ServerStore:
+    """Factions data of each server, in a file of its own.
+
+    A server's file is read the first time it is used and dropped from
+    memory once it has been idle for IDLE_TIMEOUT. Only the language lines
+    that differ from default_language are stored, the language being a
+    ChainMap of those overrides over the defaults."""
+
+    def __init__(self):
+        self.servers = {}
+        self.last_used = {}
+
+    def get(self, server_id: str) -> dict:
+        self.last_used[server_id] = time.monotonic()
+        if server_id not in self.servers:
+            path = SERVER_PATH.format(server_id)
+            if os.path.exists(path):
+                data = dataIO.load_json(path)
+            else:
+                data = {"factions": {}, "aliases": {}, "language": {}}
+            data.setdefault("rollups", {"day": {}, "week": {}})
+            data["language"] = ChainMap(data["language"], default_language)
+            self.servers[server_id] = data
+        return self.servers[server_id]
+
+    def save(self, server_id: str):
+        data = self.servers[server_id]
+        overrides = data["language"].maps[0]
+        for key in [k for k, v in overrides.items() if default_language.get(k) == v]:
+            del overrides[key]
+        dataIO.save_json(SERVER_PATH.format(server_id), dict(data, language=overrides))
+
+    def evict_idle(self) -> List[str]:
+        """Drops the servers unused for IDLE_TIMEOUT, everything being saved already"""
+        cutoff = time.monotonic() - IDLE_TIMEOUT
+        evicted = [s for s, used in self.last_used.items() if used < cutoff]
+        for server_id in evicted:
+            del self.last_used[server_id]
+            self.servers.pop(server_id, None)
+        return evicted
+
 
 class Factions:
     """Factions"""
 
     def __init__(self, bot: commands.Bot):
         self.bot = bot
-        self.json = dataIO.load_json(FILE_PATH)
+        self.store = ServerStore()
+        self.templates = {}  # server id: {(line, plural): template}, see _parse_line
+        self.leaderboards = {}  # server id: Leaderboard, see _leaderboard
+        self.indexes = {}  # server id: NameIndex, see _get_alias
+        self.activity = dataIO.load_json(ACTIVITY_PATH)
+        self.earned = defaultdict(Counter)  # server id: activity points per faction, not flushed yet
+        self.cooldowns = {}  # (server id, member id): time they can earn points again
+        self.evictor = bot.loop.create_task(self._evict_idle())
+        self.flusher = bot.loop.create_task(self._flush_activity())
+
+    def __unload(self):
+        self.evictor.cancel()
+        self.flusher.cancel()
+        self.flush_activity()
+
+    async def _evict_idle(self):
+        while True:
+            await asyncio.sleep(IDLE_TIMEOUT)
+            for server_id in self.store.evict_idle():
+                self.templates.pop(server_id, None)
+                self.leaderboards.pop(server_id, None)
+                self.indexes.pop(server_id, None)
 
     def _load_server(self, server, key: Union[str, List[str]]="factions") -> Union[dict, List[dict]]:
-        if server.id not in self.json:
-            self.json[server.id] = {"factions": {},
-                                    "aliases": {},
-                                    "language": default_language.copy()}
-            dataIO.save_json(FILE_PATH, self.json)
+        data = self.store.get(server.id)
         if isinstance(key, str):
-            return self.json[server.id][key]
+            return data[key]
         elif isinstance(key, list):
-            return [self.json[server.id][k] for k in key]
+            return [data[k] for k in key]
         elif key is None:
-            return self.json[server.id]
+            return data
         else:
             raise TypeError
 
+    def _save_server(self, server):
+        self.store.save(server.id)
+
+    def _leaderboard(self, server) -> Leaderboard:
+        if server.id not in self.leaderboards:
+            self.leaderboards[server.id] = Leaderboard(self._load_server(server))
+        return self.leaderboards[server.id]
+
+    def _record(self, server, actor: str, changes: dict):
+        """Appends points changes to the server's ledger and adds them to the day and week rollups"""
+        changes = {faction: delta for faction, delta in changes.items() if delta}
+        if not changes:
+            return
+        now = time.time()
+        with open(LEDGER_PATH.format(server.id), "a", encoding="utf-8") as f:
+            f.write("".join(json.dumps({"time": now, "by": actor, "faction": faction, "delta": delta}) + "\n"
+                            for faction, delta in changes.items()))
+        rollups = self._load_server(server, "rollups")
+        today = _day(now)
+        for rollup, bucket, kept in (("day", today, DAY_ROLLUPS), ("week", _week(today), WEEK_ROLLUPS)):
+            buckets = rollups[rollup]
+            totals = buckets.setdefault(str(bucket), {})
+            for faction, delta in changes.items():
+                totals[faction] = totals.get(faction, 0) + delta
+            for old in [b for b in buckets if int(b) <= bucket - kept]:
+                del buckets[old]
+
+    def _set_points(self, server, faction_name: str, points: int):
+        """Sets the points of a faction, keeping the leaderboard in order"""
+        self._load_server(server)[faction_name] = points
+        self._leaderboard(server).update(faction_name, points)
+
     def _get_alias(self, server, faction_name):
-        aliases = self._load_server(server, key="aliases")
-        return aliases.get(faction_name.lower(), faction_name)
+        return self._index(server).resolve(faction_name) or faction_name
+
+    def _index(self, server) -> NameIndex:
+        if server.id not in self.indexes:
+            self.indexes[server.id] = NameIndex(self._load_server(server, key="aliases"))
+        return self.indexes[server.id]
 
     def _parse_line(self, server, key, plural=True, **kwargs):
-        language = self._load_server(server, key="language")
-        kwargs.update({k: language[k] for k in ("point_name", "suffix")})
-        line = language[key]
-        if plural:
-            line = line.replace("<point_name>", "<point_name><suffix>")
-        return re.sub(r"<(.+?)>", lambda m: str(kwargs[m.group(1)]), line)
+        templates = self.templates.setdefault(server.id, {})
+        if (key, plural) not in templates:
+            language = self._load_server(server, key="language")
+            templates[(key, plural)] = _compile_line(key, language[key], language["point_name"],
+                                                     language["suffix"], plural)
+        return templates[(key, plural)].format_map(kwargs)
 
     @commands.group(pass_context=True)
     async def points(self, ctx: commands.Context):
@@ -98,22 +423,27 @@ class Factions:
             await self.bot.say(self._parse_line(server, "faction_exists", faction_name=faction_name))
         else:
             aliases[faction_name.lower()] = faction_name
-            factions[faction_name] = 0
+            self._index(server).add(faction_name, faction_name)
+            self._set_points(server, faction_name, 0)
             await self.bot.say(self._parse_line(server, "faction_create"))
-            dataIO.save_json(FILE_PATH, self.json)
+            self._save_server(server)
 
     @points.command(pass_context=True, name="delete")
     @checks.admin()
     async def faction_delete(self, ctx: commands.Context, *, faction_name: str):
         """Delete a faction and its associated points and aliases."""
         server = ctx.message.server
-        factions = self._load_server(server)
+        factions, aliases = self._load_server(server, ["factions", "aliases"])
         if faction_name not in factions:
             await self.bot.say(self._parse_line(server, "faction_no_exists", faction_name=faction_name))
         else:
+            self._leaderboard(server).remove(faction_name)
             del factions[faction_name]
+            for alias in [a for a, f in aliases.items() if f == faction_name]:
+                del aliases[alias]
+            self._index(server).remove_faction(faction_name)
             await self.bot.say(self._parse_line(server, "faction_delete"))
-            dataIO.save_json(FILE_PATH, self.json)
+            self._save_server(server)
 
     @points.command(pass_context=True, name="set")
     @checks.admin()
@@ -125,9 +455,10 @@ class Factions:
         if faction_name not in factions:
             await self.bot.say(self._parse_line(server, "faction_no_exists", faction_name=faction_name))
         else:
-            factions[faction_name] = points
+            self._record(server, ctx.message.author.id, {faction_name: points - factions[faction_name]})
+            self._set_points(server, faction_name, points)
             await self.bot.say(self._parse_line(server, "points_set", faction_name=faction_name, points=points))
-            dataIO.save_json(FILE_PATH, self.json)
+            self._save_server(server)
 
     @points.command(pass_context=True, name="reset")
     @checks.admin()
@@ -140,10 +471,12 @@ class Factions:
         if answer is None or "yes" not in answer.content.lower():
             await self.bot.say(self._parse_line(server, "reset_no"))
         else:
+            self._record(server, ctx.message.author.id, {faction: -points for faction, points in factions.items()})
             for faction in factions:
                 factions[faction] = 0
+            self.leaderboards.pop(server.id, None)
             await self.bot.say(self._parse_line(server, "reset_yes"))
-            dataIO.save_json(FILE_PATH, self.json)
+            self._save_server(server)
 
     @points.group(pass_context=True)
     @checks.admin()
@@ -162,8 +495,9 @@ class Factions:
             await self.bot.say(self._parse_line(server, "faction_no_exists", faction_name=faction_name))
         else:
             aliases[alias.lower()] = faction_name
+            self._index(server).add(alias, faction_name)
             await self.bot.say(self._parse_line(server, "alias_new"))
-            dataIO.save_json(FILE_PATH, self.json)
+            self._save_server(server)
 
     @alias.command(pass_context=True, name="delete")
     @checks.admin()
@@ -172,11 +506,12 @@ class Factions:
         server = ctx.message.server
         aliases = self._load_server(server, "aliases")
         if alias.lower() not in aliases:
-            await self.bot.say(self._parse_line(server, "faction_no_exists", alias=alias))
+            await self.bot.say(self._parse_line(server, "alias_no_exists", alias=alias))
         else:
+            self._index(server).remove(alias)
             del aliases[alias.lower()]
             await self.bot.say(self._parse_line(server, "alias_delete"))
-            dataIO.save_json(FILE_PATH, self.json)
+            self._save_server(server)
 
     @alias.command(pass_context=True, name="list")
     @checks.admin()
@@ -203,9 +538,7 @@ class Factions:
     @checks.admin()
     async def lang_edit(self, ctx: commands.Context, lang_name: str, new_lang: str):
         """Edits a line in the language.
-        WARNING: Make sure you know what parameters are in the line!
-        Misspellings of parameter names will likely result in a crash.
-        Also note that if a parameter is not used in the default language line, it is not available for use in your custom language line.
+        Only the parameters used in the default language line, along with <point_name> and <suffix>, are available for use in your custom language line; lines using any other parameter are refused.
         Finally, any multi-word language lines must be encapsulated in quotes, as seen in the first example.
 
         Examples: [p]points language edit points_added \"<faction_name> has earned <points> <point_name>!\"
@@ -216,9 +549,17 @@ class Factions:
         language = self._load_server(server, "language")
         if lang_name not in language:
             await self.bot.say(self._parse_line(server, "lang_no_line", lang_name=lang_name))
+            return
+        allowed = _allowed_placeholders(lang_name)
+        unknown = [p for p in PLACEHOLDER.findall(new_lang) if p not in allowed]
+        if unknown:
+            await self.bot.say(self._parse_line(server, "lang_bad_placeholder", lang_name=lang_name,
+                                                placeholder="<%s>" % unknown[0],
+                                                allowed=", ".join("<%s>" % p for p in sorted(allowed)) or "none"))
         else:
             language[lang_name] = new_lang
-            dataIO.save_json(FILE_PATH, self.json)
+            self.templates.pop(server.id, None)
+            self._save_server(server)
 
     @language.command(pass_context=True,  name="list")
     @checks.admin()
@@ -236,8 +577,9 @@ class Factions:
         """Resets all language back to defaults."""
         server = ctx.message.server
         language = self._load_server(server, "language")
-        language.update(default_language)
-        dataIO.save_json(FILE_PATH, self.json)
+        language.maps[0].clear()
+        self.templates.pop(server.id, None)
+        self._save_server(server)
         await self.bot.say(self._parse_line(server, "lang_reset"))
 
     @points.command(pass_context=True)
@@ -246,15 +588,101 @@ class Factions:
         """Adds a given number of points to a faction."""
         server = ctx.message.server
         if points <= 0:
-            await self.bot.say(self._parse_line(server, "points_added", plural=False))
+            await self.bot.say(self._parse_line(server, "points_bad", plural=False))
+            return
         faction_name = self._get_alias(server, faction_name)
         factions = self._load_server(server)
         if faction_name not in factions:
             await self.bot.say(self._parse_line(server, "faction_no_exists", faction_name=faction_name))
         else:
-            factions[faction_name] += points
+            self._set_points(server, faction_name, factions[faction_name] + points)
+            self._record(server, ctx.message.author.id, {faction_name: points})
             await self.bot.say(self._parse_line(server, "points_added", plural=points > 1, points=points, faction_name=faction_name, new_points=factions[faction_name]))
-            dataIO.save_json(FILE_PATH, self.json)
+            self._save_server(server)
+
+    @points.command(pass_context=True)
+    @checks.mod_or_permissions(administrator=True)
+    async def bulk(self, ctx: commands.Context, *, entries: str=""):
+        """Changes the points of many factions at once.
+
+        Takes a "faction points" entry per line, or attached .csv files of faction,points rows.
+        Positive points are added and negative ones removed. Nothing is changed unless every entry is valid.
+
+        Example: [p]points bulk
+                 gryffindor +50
+                 slytherin -10"""
+        server = ctx.message.server
+        files = []
+        file_errors = []
+        for attachment in ctx.message.attachments:
+            filename = attachment.get("filename", "")
+            if not filename.lower().endswith(".csv"):
+                continue
+            try:
+                async with aiohttp.get(attachment["url"]) as r:
+                    if r.status != 200:
+                        file_errors.append((filename, "could not be downloaded"))
+                        continue
+                    files.append((await r.read()).decode("utf-8-sig"))
+            except UnicodeDecodeError:
+                file_errors.append((filename, "is not a UTF-8 text file"))
+            except aiohttp.ClientError:
+                file_errors.append((filename, "could not be downloaded"))
+        factions = self._load_server(server)
+        changes, errors = self._parse_bulk(server, entries, files)
+        errors = file_errors + errors
+        if not (changes or errors):
+            await self.bot.say(self._parse_line(server, "bulk_none", prefix=ctx.prefix))
+            return
+        for faction_name, change in changes.items():
+            if factions[faction_name] + change < 0:
+                errors.append((faction_name, "would have fewer than zero"))
+        if errors:
+            await self.bot.say(self._parse_line(server, "bulk_bad"))
+            for page in pagify(tabulate(errors), ["\n"]):
+                await self.bot.say(box(page))
+            return
+
+        table = []
+        for faction_name, change in changes.items():
+            self._set_points(server, faction_name, factions[faction_name] + change)
+            table.append((faction_name, "%+d" % change, factions[faction_name]))
+        self._record(server, ctx.message.author.id, changes)
+        self._save_server(server)
+        await self.bot.say(self._parse_line(server, "bulk_done", count=len(changes)))
+        for page in pagify(tabulate(table, self._parse_line(server, "FactionChangeTotal").split()), ["\n"]):
+            await self.bot.say(box(page))
+
+    def _parse_bulk(self, server, entries: str, files: List[str]):
+        """Returns the total change of each faction in bulk entries and CSV files, and the invalid entries"""
+        factions = self._load_server(server)
+        changes = {}
+        errors = []
+        rows = [(row, False) for row in csv.reader(io.StringIO(entries))]
+        for text in files:
+            rows.extend((row, i == 0) for i, row in enumerate(r for r in csv.reader(io.StringIO(text)) if any(r)))
+        for row, first_csv_row in rows:
+            row = [field.strip() for field in row if field.strip()]
+            if len(row) == 1:
+                row = row[0].rsplit(None, 1)
+            if not row:
+                continue
+            entry = " ".join(row)
+            if len(row) != 2:
+                errors.append((entry, "should be a faction and points"))
+                continue
+            faction_name = self._get_alias(server, row[0])
+            try:
+                points = int(row[1])
+            except ValueError:
+                if not first_csv_row:  # otherwise a header, like faction,points
+                    errors.append((entry, "points should be a whole number"))
+                continue
+            if faction_name not in factions:
+                errors.append((entry, "no such faction"))
+            else:
+                changes[faction_name] = changes.get(faction_name, 0) + points
+        return changes, errors
 
     @points.command(pass_context=True)
     @checks.mod_or_permissions(administrator=True)
@@ -270,9 +698,10 @@ class Factions:
                 await self.bot.say(self._parse_line(server, "points_zero", faction_name=faction_name))
                 return
             points = min(points, factions[faction_name])
-            factions[faction_name] -= points
+            self._set_points(server, faction_name, factions[faction_name] - points)
+            self._record(server, ctx.message.author.id, {faction_name: -points})
             await self.bot.say(self._parse_line(server, "points_removed", plural=points > 1, points=points, faction_name=faction_name, new_points=factions[faction_name]))
-            dataIO.save_json(FILE_PATH, self.json)
+            self._save_server(server)
 
     @points.command(pass_context=True)
     async def check(self, ctx: commands.Context, *, faction_name: str):
@@ -287,30 +716,219 @@ class Factions:
             await self.bot.say(self._parse_line(server, "points_faction", plural=points > 1, faction_name=faction_name, points=points))
 
     @points.command(pass_context=True)
-    async def checkall(self, ctx: commands.Context):
-        """Lists the point tallies for all factions."""
+    async def checkall(self, ctx: commands.Context, page: int=1):
+        """Lists the point tallies for all factions, a page at a time."""
         server = ctx.message.server
-        factions = self._load_server(server)
-        if not factions:
+        leaderboard = self._leaderboard(server)
+        pages = (len(leaderboard) - 1) // PAGE_SIZE + 1
+        if not leaderboard:
             await self.bot.say(self._parse_line(server, "faction_none", prefix=ctx.prefix))
+        elif not 1 <= page <= pages:
+            await self.bot.say(self._parse_line(server, "page_no_exists", page=page, pages=pages))
+        else:
+            await self.bot.say(self._ranking(server, leaderboard.top(PAGE_SIZE, (page - 1) * PAGE_SIZE)))
+
+    @points.command(pass_context=True)
+    async def rank(self, ctx: commands.Context, *, faction_name: str):
+        """Shows the rank of a faction and the factions around it."""
+        server = ctx.message.server
+        faction_name = self._get_alias(server, faction_name)
+        leaderboard = self._leaderboard(server)
+        if faction_name not in leaderboard.points:
+            await self.bot.say(self._parse_line(server, "faction_no_exists", faction_name=faction_name))
+        else:
+            points = leaderboard.points[faction_name]
+            await self.bot.say(self._parse_line(server, "rank_faction", plural=points > 1, faction_name=faction_name,
+                                                rank=leaderboard.rank(faction_name), count=len(leaderboard),
+                                                points=points))
+            await self.bot.say(self._ranking(server, leaderboard.neighbours(faction_name)))
+
+    @points.command(pass_context=True)
+    async def top(self, ctx: commands.Context, period: str="week"):
+        """Lists the factions that gained the most points within a window.
+
+        The window is today, week (this week, the default), or a number of days or weeks.
+        Example: [p]points top 30d"""
+        server = ctx.message.server
+        factions, rollups = self._load_server(server, ["factions", "rollups"])
+        try:
+            rollup, buckets = _parse_period(period, _day(time.time()))
+        except ValueError:
+            await self.bot.say(self._parse_line(server, "period_bad", period=period))
+            return
+        gained = dict.fromkeys(factions, 0)
+        for bucket in buckets:
+            for faction, delta in rollups[rollup].get(str(bucket), {}).items():
+                if faction in gained:
+                    gained[faction] += delta
+        if not gained:
+            await self.bot.say(self._parse_line(server, "faction_none", prefix=ctx.prefix))
+        else:
+            leaderboard = Leaderboard(gained)
+            await self.bot.say(self._ranking(server, leaderboard.top(PAGE_SIZE)))
+
+    @points.command(pass_context=True)
+    async def history(self, ctx: commands.Context, faction_name: str, period: str="7d"):
+        """Shows the daily point changes of a faction within a window.
+
+        The window is today, week, or a number of days or weeks, 7 days by default.
+        Example: [p]points history gryffindor 4w"""
+        server = ctx.message.server
+        faction_name = self._get_alias(server, faction_name)
+        factions, rollups = self._load_server(server, ["factions", "rollups"])
+        if faction_name not in factions:
+            await self.bot.say(self._parse_line(server, "faction_no_exists", faction_name=faction_name))
+            return
+        try:
+            rollup, buckets = _parse_period(period, _day(time.time()))
+        except ValueError:
+            await self.bot.say(self._parse_line(server, "period_bad", period=period))
+            return
+        if rollup == "week":
+            # weeks are shown day by day, as far back as the daily totals go
+            buckets = range(max(buckets[0] * 7 - 3, _day(time.time()) - DAY_ROLLUPS + 1), buckets[-1] * 7 + 4)
+        table = []
+        for day in buckets:
+            delta = rollups["day"].get(str(day), {}).get(faction_name)
+            if delta:
+                table.append((datetime.utcfromtimestamp(day * DAY).strftime("%Y-%m-%d"), "%+d" % delta))
+        if not table:
+            await self.bot.say(self._parse_line(server, "history_none", faction_name=faction_name))
+            return
+        total = sum(int(delta) for _, delta in table)
+        await self.bot.say(self._parse_line(server, "history_faction", plural=abs(total) > 1,
+                                            faction_name=faction_name, points="%+d" % total))
+        for page in pagify(tabulate(table, self._parse_line(server, "DayChange").split()), ["\n"]):
+            await self.bot.say(box(page))
+
+    def _ranking(self, server, rows: List[tuple]) -> str:
+        headers = (self._parse_line(server, "Rank"), self._parse_line(server, "Faction"),
+                   self._parse_line(server, "point_name").title() + self._parse_line(server, "suffix"))
+        return box(tabulate(rows, headers))
+
+    @points.group(pass_context=True)
+    @checks.admin()
+    async def activity(self, ctx: commands.Context):
+        """Award points to factions for their members chatting."""
+        if ctx.invoked_subcommand is self.activity:
+            await send_cmd_help(ctx)
+
+    def _activity_settings(self, server) -> dict:
+        return self.activity.setdefault(server.id, {"enabled": False, "roles": {}, "points": 1, "cooldown": 60})
+
+    @activity.command(pass_context=True, name="toggle")
+    @checks.admin()
+    async def activity_toggle(self, ctx: commands.Context):
+        """Turns activity points on or off."""
+        server = ctx.message.server
+        settings = self._activity_settings(server)
+        settings["enabled"] = not settings["enabled"]
+        dataIO.save_json(ACTIVITY_PATH, self.activity)
+        await self.bot.say(self._parse_line(server, "activity_on" if settings["enabled"] else "activity_off"))
+
+    @activity.command(pass_context=True, name="role")
+    @checks.admin()
+    async def activity_role(self, ctx: commands.Context, role: discord.Role, *, faction_name: str=None):
+        """Makes members with a role earn points for a faction, or nothing when no faction is given."""
+        server = ctx.message.server
+        roles = self._activity_settings(server)["roles"]
+        if faction_name is None:
+            roles.pop(role.id, None)
+            await self.bot.say(self._parse_line(server, "activity_role_none", role=role.name))
         else:
-            await self.bot.say(box(tabulate(sorted(factions.items(), key=lambda k: k[1], reverse=True), (self._parse_line(server, "Faction"), self._parse_line(server, "point_name").title()+self._parse_line(server, "suffix")))))
+            faction_name = self._get_alias(server, faction_name)
+            if faction_name not in self._load_server(server):
+                await self.bot.say(self._parse_line(server, "faction_no_exists", faction_name=faction_name))
+                return
+            roles[role.id] = faction_name
+            await self.bot.say(self._parse_line(server, "activity_role", role=role.name, faction_name=faction_name))
+        dataIO.save_json(ACTIVITY_PATH, self.activity)
 
+    @activity.command(pass_context=True, name="rate")
+    @checks.admin()
+    async def activity_rate(self, ctx: commands.Context, points: int, cooldown: int):
+        """Sets the points earned per message, and the seconds a member waits before earning more."""
+        server = ctx.message.server
+        if points <= 0:
+            await self.bot.say(self._parse_line(server, "points_bad", plural=False))
+            return
+        if cooldown < 0:
+            await self.bot.say(self._parse_line(server, "cooldown_bad"))
+            return
+        settings = self._activity_settings(server)
+        settings["points"], settings["cooldown"] = points, cooldown
+        dataIO.save_json(ACTIVITY_PATH, self.activity)
+        await self.bot.say(self._parse_line(server, "activity_rate", plural=points > 1, points=points,
+                                            cooldown=cooldown))
+
+    async def on_message(self, message):
+        """Counts activity points, only in memory, see flush_activity"""
+        if message.server is None or message.author.bot:
+            return
+        settings = self.activity.get(message.server.id)
+        if not (settings and settings["enabled"]):
+            return
+        key = (message.server.id, message.author.id)
+        now = time.monotonic()
+        if self.cooldowns.get(key, 0) > now:
+            return
+        for role in message.author.roles:
+            faction_name = settings["roles"].get(role.id)
+            if faction_name is not None:
+                self.earned[message.server.id][faction_name] += settings["points"]
+                self.cooldowns[key] = now + settings["cooldown"]
+                return
+
+    async def _flush_activity(self):
+        while True:
+            await asyncio.sleep(FLUSH_INTERVAL)
+            self.flush_activity()
+
+    def flush_activity(self):
+        """Adds the activity points earned since the last flush, saving each server once"""
+        earned, self.earned = self.earned, defaultdict(Counter)
+        for server_id, points in earned.items():
+            server = self.bot.get_server(server_id)
+            if server is None:
+                continue
+            factions = self._load_server(server)
+            points = {faction: p for faction, p in points.items() if faction in factions}
+            if not points:
+                continue
+            for faction_name, p in points.items():
+                self._set_points(server, faction_name, factions[faction_name] + p)
+            self._record(server, "activity", points)
+            self._save_server(server)
+        now = time.monotonic()
+        for key in [k for k, until in self.cooldowns.items() if until <= now]:
+            del self.cooldowns[key]
 
 def check_folder():
-    folder = os.path.dirname(FILE_PATH)
-    if not os.path.exists(folder):
-        log.debug('Creating folder: %s' % folder)
-        os.makedirs(folder)
+    for folder in (os.path.dirname(SERVER_PATH), os.path.dirname(LEDGER_PATH)):
+        if not os.path.exists(folder):
+            log.debug('Creating folder: %s' % folder)
+            os.makedirs(folder)
 
 
 def check_file():
-    if dataIO.is_valid_json(FILE_PATH) is False:
-        log.debug('Creating json: %s' % os.path.basename(FILE_PATH))
-        dataIO.save_json(FILE_PATH, {})
+    if dataIO.is_valid_json(ACTIVITY_PATH) is False:
+        log.debug('Creating json: %s' % os.path.basename(ACTIVITY_PATH))
+        dataIO.save_json(ACTIVITY_PATH, {})
+
+
+def migrate():
+    """Splits the old settings.json into a file per server"""
+    if not dataIO.is_valid_json(FILE_PATH):
+        return
+    for server_id, data in dataIO.load_json(FILE_PATH).items():
+        data["language"] = {k: v for k, v in data["language"].items() if default_language.get(k) != v}
+        dataIO.save_json(SERVER_PATH.format(server_id), data)
+    os.replace(FILE_PATH, FILE_PATH + ".migrated")
+    log.info('Moved factions data to a file per server')
 
 
 def setup(bot):
     check_folder()
     check_file()
+    migrate()
     bot.add_cog(Factions(bot))
@@ -0,0 +1,270 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks for the maze engine and the game loop.
+
+Times generation, rendering and snapshots across board sizes, tracks the
+peak memory of building a maze, and plays scripted games through
+`MazeCog.play_maze` with a stand-in bot. Results are written as JSON so
+changes to the engine can be compared against a baseline.
+
+The cog is imported the way Red imports it, so run this from the root of a
+Red install (or pass --red):
+
+    python path/to/maze/benchmark.py --output before.json
+    python path/to/maze/benchmark.py --baseline before.json --output after.json
+"""
+import argparse
+import asyncio
+import importlib.util
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+
+DEFAULT_SIZES = ["10x10", "20x10", "50x50", "100x100", "250x250",
+                 "500x500", "1000x1000", "2000x2000"]
+SEED = 1234
+
+
+async def send_cmd_help(ctx):
+    """The cog imports this from __main__, which is this script."""
+    pass
+
+
+def load_maze_module(red_path):
+    sys.path.insert(0, os.path.abspath(red_path))
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "maze.py")
+    spec = importlib.util.spec_from_file_location("cogs.maze", path)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules["cogs.maze"] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+def best_time(func, budget=0.5, max_runs=20):
+    """Returns the best of as many runs of func as fit in the time budget."""
+    times = []
+    started = time.perf_counter()
+    while len(times) < max_runs:
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+        if time.perf_counter() - started > budget:
+            break
+    return min(times)
+
+
+def bench_engine(module, width, height, measure_memory=True):
+    Maze = module.Maze
+    maze = Maze.generate(width, height, SEED)
+    maze.wall_rows()
+    snapshot = maze.to_bytes()
+    result = {
+        "size": "{}x{}".format(width, height),
+        "cells": width * height,
+        "generate_s": best_time(lambda: Maze.generate(width, height, SEED)),
+        "randomize_s": best_time(lambda: Maze(width, height, seed=SEED).randomize()),
+        "matrix_s": best_time(maze._matrix),
+        "repr_s": best_time(lambda: repr(maze)),
+        "to_bytes_s": best_time(maze.to_bytes),
+        "from_bytes_s": best_time(lambda: Maze.from_bytes(snapshot)),
+        "snapshot_bytes": len(snapshot),
+    }
+    if measure_memory:
+        tracemalloc.start()
+        module._build_maze(width, height, SEED)
+        result["peak_memory_bytes"] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return result
+
+
+##################
+# STAND-IN BOT   #
+##################
+
+class StandIn:
+    def __init__(self, **attributes):
+        self.__dict__.update(attributes)
+
+
+class StandInBot:
+    """Just enough of a bot for the cog, answering after a fixed latency."""
+
+    def __init__(self, loop, latency):
+        self.loop = loop
+        self.latency = latency
+        self.user = StandIn(id="0", display_name="bot")
+        self.messages = []
+        self.edits = 0
+        self._ids = 0
+
+    async def _call(self):
+        await asyncio.sleep(self.latency)
+
+    async def send_message(self, channel, content):
+        await self._call()
+        self._ids += 1
+        return StandIn(id=str(self._ids), channel=channel, content=content)
+
+    async def say(self, content):
+        return await self.send_message(self.channel, content)
+
+    async def edit_message(self, message, content):
+        await self._call()
+        self.edits += 1
+        return StandIn(id=message.id, channel=message.channel, content=content)
+
+    async def add_reaction(self, message, emoji):
+        await self._call()
+
+    async def remove_reaction(self, message, emoji, member):
+        await self._call()
+
+    async def delete_message(self, message):
+        await self._call()
+
+    async def wait_until_ready(self):
+        pass
+
+
+def scripted_moves(module, maze, dashing):
+    """Returns the emojis solving the maze by following its hints."""
+    moves = [em for em, choice in module.CHOICES.items() if choice == "dash" and dashing]
+    position = maze.player
+    while position != maze.target:
+        direction = maze.hint(position)
+        moves.append(module.ARROWS[direction])
+        position = maze.move(position, direction, dashing)
+    return moves
+
+
+async def play_scripted(module, cog, bot, ctx, width, height, dashing):
+    """Plays one game through the maze command and returns its stats."""
+    player = ctx.message.author
+    game = bot.loop.create_task(cog.play_maze.callback(cog, ctx, width, height))
+    # Wait for the game to be listening for reactions.
+    while not cog.dispatcher.listeners:
+        await asyncio.sleep(0)
+    session = next(iter(cog.sessions.sessions.values()))
+    moves = scripted_moves(module, session.maze, dashing)
+    edits = bot.edits
+    started = time.perf_counter()
+    for emoji in moves:
+        reaction = StandIn(emoji=emoji, message=session.message)
+        await cog.on_reaction_add(reaction, player)
+    while not session.finished():
+        await asyncio.sleep(0)
+    applied = time.perf_counter() - started
+    await game
+    return {"moves": len(moves),
+            "edits": bot.edits - edits,
+            "applied_seconds": applied,
+            "seconds": time.perf_counter() - started}
+
+
+def bench_game(module, games, width, height, latency, dashing):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    bot = StandInBot(loop, latency)
+    server = StandIn(id="1", me=bot.user)
+    bot.channel = StandIn(id="2", server=server, is_private=False)
+    author = StandIn(id="3", display_name="player", mention="<@3>")
+    ctx = StandIn(message=StandIn(author=author, server=server, channel=bot.channel))
+
+    async def run():
+        cog = module.MazeCog(bot)
+        try:
+            plays = [await play_scripted(module, cog, bot, ctx, width, height, dashing)
+                     for _ in range(games)]
+            return plays, cog.sessions
+        finally:
+            for task in cog.tasks:
+                task.cancel()
+            cog.pool.stop()
+
+    try:
+        plays, sessions = loop.run_until_complete(run())
+    finally:
+        loop.close()
+    moves = sum(play["moves"] for play in plays)
+    applied = sum(play["applied_seconds"] for play in plays)
+    return {"mode": "dash" if dashing else "step",
+            "size": "{}x{}".format(width, height),
+            "games": games,
+            "moves": moves,
+            "edits": sum(play["edits"] for play in plays),
+            "seconds": sum(play["seconds"] for play in plays),
+            "moves_per_s": moves / applied if applied else 0.0,
+            "average_latency_s": sessions.average_latency(),
+            "max_latency_s": sessions.max_latency}
+
+
+def compare(results, baseline):
+    """Prints every timing next to its baseline."""
+    def rows(section):
+        return {row["size"] + row.get("mode", ""): row for row in section}
+
+    for section in ("engine", "game"):
+        old = rows(baseline.get(section, []))
+        for key, row in rows(results[section]).items():
+            if key not in old:
+                continue
+            for metric, value in sorted(row.items()):
+                before = old[key].get(metric)
+                if isinstance(value, float) and before:
+                    print("{:8} {:12} {:18} {:12.6f} -> {:12.6f} ({:+.1%})".format(
+                        section, key, metric, before, value, value / before - 1))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the maze cog.")
+    parser.add_argument("--red", default=".", help="root of the Red install")
+    parser.add_argument("--sizes", nargs="+", default=DEFAULT_SIZES, help="sizes as WIDTHxHEIGHT")
+    parser.add_argument("--no-memory", action="store_true", help="skip peak memory tracking")
+    parser.add_argument("--games", type=int, default=5, help="scripted games per mode")
+    parser.add_argument("--latency", type=float, default=0.05, help="stand-in API latency in seconds")
+    parser.add_argument("--output", help="file to write the JSON results to")
+    parser.add_argument("--baseline", help="JSON results to compare against")
+    args = parser.parse_args()
+
+    module = load_maze_module(args.red)
+    results = {"python": platform.python_version(),
+               "platform": platform.platform(),
+               "time": time.time(),
+               "engine": [],
+               "game": []}
+
+    for size in args.sizes:
+        width, height = (int(n) for n in size.lower().split("x"))
+        row = bench_engine(module, width, height, not args.no_memory)
+        results["engine"].append(row)
+        print(json.dumps(row))
+
+    # The game runs in a temporary directory, as the cog saves its data
+    # relative to the working directory.
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as directory:
+        os.chdir(directory)
+        try:
+            module.check_folder()
+            module.check_file()
+            for dashing in (False, True):
+                row = bench_game(module, args.games, 20, 10, args.latency, dashing)
+                results["game"].append(row)
+                print(json.dumps(row))
+        finally:
+            os.chdir(cwd)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=4)
+    if args.baseline:
+        with open(args.baseline) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
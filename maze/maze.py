@@ -1,18 +1,46 @@
 # -*- coding: utf-8 -*-
 import random
+import struct
+from array import array
+from collections import namedtuple
 
 # Easy to read representation for each cardinal direction.
 N, S, W, E = ('n', 's', 'w', 'e')
+# Each direction with its (x, y) offset, the index in this tuple is what the
+# solver stores per cell.
+DIRECTIONS = ((N, 0, -1), (S, 0, 1), (W, -1, 0), (E, 1, 0))
+DIRECTION_INDEX = {direction: i for i, (direction, _, _) in enumerate(DIRECTIONS)}
+# Stored in `Maze.next_move` for cells without a move, i.e. the target.
+NO_MOVE = 255
+
+# Bit of each direction in a cell's wall mask, in the order of DIRECTIONS.
+WALL_BITS = {N: 1, S: 2, W: 4, E: 8}
+ALL_WALLS = 15
+
+Rating = namedtuple('Rating', ['path_length', 'dead_ends'])
+
+# Snapshot header: magic, version, flags, width, height, player x and y,
+# target x and y, seed. Followed by the wall masks, two cells per byte.
+SNAPSHOT_HEADER = struct.Struct('<4sBBIIIIIIQ')
+SNAPSHOT_MAGIC = b'MAZE'
+SNAPSHOT_VERSION = 1
+SNAPSHOT_HAS_SEED = 1
 
 class Cell(object):
     """
-    Class for each individual cell. Knows only its position and which walls are
-    still standing.
+    View of an individual cell. Knows only its position and which walls are
+    still standing, the walls themselves are stored compactly by the maze.
     """
-    def __init__(self, x, y, walls):
+    def __init__(self, maze, x, y):
+        self.maze = maze
         self.x = x
         self.y = y
-        self.walls = set(walls)
+        self.index = x + y * maze.width
+
+    @property
+    def walls(self):
+        mask = self.maze.walls[self.index]
+        return {direction for direction, bit in WALL_BITS.items() if mask & bit}
 
     def __repr__(self):
         # <15, 25 (es  )>
@@ -20,13 +48,13 @@ class Cell(object):
 
     def __contains__(self, item):
         # N in cell
-        return item in self.walls
+        return bool(self.maze.walls[self.index] & WALL_BITS[item])
 
     def is_full(self):
         """
         Returns True if all walls are still standing.
         """
-        return len(self.walls) == 4
+        return self.maze.walls[self.index] == ALL_WALLS
 
     def _wall_to(self, other):
         """
@@ -49,8 +77,9 @@ class Cell(object):
         """
         Removes the wall between two adjacent cells.
         """
-        other.walls.remove(other._wall_to(self))
-        self.walls.remove(self._wall_to(other))
+        walls = self.maze.walls
+        walls[other.index] &= ~WALL_BITS[other._wall_to(self)]
+        walls[self.index] &= ~WALL_BITS[self._wall_to(other)]
 
 class Maze(object):
     """
@@ -74,24 +103,36 @@ class Maze(object):
                               'n': '╵',
                               'w': '╴'}
 
-    def __init__(self, width=20, height=10, player=None, target=None):
+    def __init__(self, width=20, height=10, player=None, target=None, seed=None):
         """
         Creates a new maze with the given sizes, with all walls standing.
+        Passing a seed makes positions and generation reproducible.
         """
         self.width = width
         self.height = height
+        self.seed = seed
+        self.random = random.Random(seed)
+        self.player = player
         self.target = target
+        self._rendered = None
+        self.distances = None
+        self.next_move = None
+        self.dash_to = None
         if not (player and target):
             self.player = self._get_random_position()
             self.target = self._get_random_position()
-            while self.target == self.player:
+            while self.target == self.player and width * height > 1:
                 self.target = self._get_random_position()
-                
-            
-        self.cells = []
-        for y in range(self.height):
-            for x in range(self.width):
-                self.cells.append(Cell(x, y, [N, S, E, W]))
+
+        # One wall mask per cell, row by row, see WALL_BITS.
+        self.walls = bytearray([ALL_WALLS]) * (width * height)
+
+    @property
+    def cells(self):
+        """
+        Returns a view of every cell, row by row.
+        """
+        return [Cell(self, x, y) for y in range(self.height) for x in range(self.width)]
 
     def __getitem__(self, index):
         """
@@ -99,7 +140,7 @@ class Maze(object):
         """
         x, y = index
         if 0 <= x < self.width and 0 <= y < self.height:
-            return self.cells[x + y * self.width]
+            return Cell(self, x, y)
         else:
             return None
 
@@ -119,8 +160,8 @@ class Maze(object):
         """
         Returns a random position on the maze.
         """
-        return (random.randrange(0, self.width),
-                random.randrange(0, self.height))
+        return (self.random.randrange(0, self.width),
+                self.random.randrange(0, self.height))
         
     def _adjust_pos(self, tup):
         return (tup[1] * 2 + 1, tup[0] * 4 + 2)
@@ -145,17 +186,17 @@ class Maze(object):
         str_matrix = [['O'] * (self.width * 2 + 1)
                       for i in range(self.height * 2 + 1)]
 
-        for cell in self.cells:
-            x = cell.x * 2 + 1
-            y = cell.y * 2 + 1
+        for index, mask in enumerate(self.walls):
+            x = index % self.width * 2 + 1
+            y = index // self.width * 2 + 1
             str_matrix[y][x] = ' '
-            if N not in cell and y > 0:
+            if not mask & WALL_BITS[N] and y > 0:
                 str_matrix[y - 1][x + 0] = ' '
-            if S not in cell and y + 1 < self.width:
+            if not mask & WALL_BITS[S] and y + 1 < self.width:
                 str_matrix[y + 1][x + 0] = ' '
-            if W not in cell and x > 0:
+            if not mask & WALL_BITS[W] and x > 0:
                 str_matrix[y][x - 1] = ' '
-            if E not in cell and x + 1 < self.width:
+            if not mask & WALL_BITS[E] and x + 1 < self.width:
                 str_matrix[y][x + 1] = ' '
 
         return str_matrix
@@ -235,13 +276,35 @@ class Maze(object):
                 matrix[y][x] = Maze.UNICODE_BY_CONNECTIONS[str_connections]
         return matrix
 
+    def wall_rows(self):
+        """
+        Returns the Unicode rows of the maze without any markers. The walls
+        never change once the maze is generated, so the render is cached.
+        """
+        if self._rendered is None:
+            self._rendered = tuple(''.join(line) for line in self._matrix())
+        return self._rendered
+
+    def render(self, markers):
+        """
+        Returns the cached wall render with each (position, char) marker from
+        `markers` drawn on top, later markers winning.
+        """
+        rows = list(self.wall_rows())
+        # Group markers per row so each touched row is rebuilt only once.
+        by_row = {}
+        for position, char in markers:
+            y, x = self._adjust_pos(position)
+            by_row.setdefault(y, []).append((x, char))
+        for y, row_markers in by_row.items():
+            row = list(rows[y])
+            for x, char in row_markers:
+                row[x] = char
+            rows[y] = ''.join(row)
+        return '\n'.join(rows) + '\n'
+
     def __repr__(self):
-        mat = self._matrix()
-        player = self._adjust_pos(self.player)
-        target = self._adjust_pos(self.target)
-        mat[target[0]][target[1]] = "$"
-        mat[player[0]][player[1]] = "@"
-        return '\n'.join(''.join(line) for line in mat) + '\n'
+        return self.render(((self.target, "$"), (self.player, "@")))
 
     def randomize(self):
         """
@@ -249,28 +312,235 @@ class Maze(object):
 
         Algorithm from http://mazeworks.com/mazegen/mazetut/index.htm
         """
+        walls = self.walls
+        width = self.width
+        size = len(walls)
         cell_stack = []
-        cell = random.choice(self.cells)
+        index = self.random.randrange(size)
         n_visited_cells = 1
 
-        while n_visited_cells < len(self.cells):
-            neighbors = [c for c in self.neighbors(cell) if c.is_full()]
+        while n_visited_cells < size:
+            x = index % width
+            neighbors = []
+            if index >= width and walls[index - width] == ALL_WALLS:
+                neighbors.append((N, S, index - width))
+            if index + width < size and walls[index + width] == ALL_WALLS:
+                neighbors.append((S, N, index + width))
+            if x > 0 and walls[index - 1] == ALL_WALLS:
+                neighbors.append((W, E, index - 1))
+            if x + 1 < width and walls[index + 1] == ALL_WALLS:
+                neighbors.append((E, W, index + 1))
             if len(neighbors):
-                neighbor = random.choice(neighbors)
-                cell.connect(neighbor)
-                cell_stack.append(cell)
-                cell = neighbor
+                wall, other_wall, neighbor = self.random.choice(neighbors)
+                walls[index] &= ~WALL_BITS[wall]
+                walls[neighbor] &= ~WALL_BITS[other_wall]
+                cell_stack.append(index)
+                index = neighbor
                 n_visited_cells += 1
             else:
-                cell = cell_stack.pop()
+                index = cell_stack.pop()
+        self._rendered = None
+
+    def _exits(self, index):
+        """
+        Returns (direction index, neighbor index) for every open wall of the
+        cell at the given index.
+        """
+        mask = self.walls[index]
+        exits = []
+        for i, (direction, difx, dify) in enumerate(DIRECTIONS):
+            if not mask & WALL_BITS[direction]:
+                exits.append((i, index + difx + dify * self.width))
+        return exits
+
+    def _bfs(self, start):
+        """
+        Returns the distance from the cell at index `start` to every cell, and
+        the index of the farthest one.
+        """
+        distances = array('i', [-1]) * len(self.walls)
+        distances[start] = 0
+        queue = [start]
+        for index in queue:
+            distance = distances[index] + 1
+            for _, neighbor in self._exits(index):
+                if distances[neighbor] < 0:
+                    distances[neighbor] = distance
+                    queue.append(neighbor)
+        return distances, queue[-1]
+
+    def _position(self, index):
+        return (index % self.width, index // self.width)
+
+    def place_endpoints(self):
+        """
+        Places the player and the target at the two ends of the longest path
+        in the maze. Two searches suffice since a perfect maze is a tree.
+        """
+        _, first = self._bfs(self.random.randrange(len(self.walls)))
+        _, second = self._bfs(first)
+        if self.random.random() < 0.5:
+            first, second = second, first
+        self.player = self._position(first)
+        self.target = self._position(second)
+
+    def solve(self):
+        """
+        Computes the distance of every cell to the target, and the direction
+        of the next correct move from every cell.
+        """
+        x, y = self.target
+        target = x + y * self.width
+        distances, _ = self._bfs(target)
+        next_move = bytearray([NO_MOVE]) * len(self.walls)
+        for index, distance in enumerate(distances):
+            for direction, neighbor in self._exits(index):
+                if distances[neighbor] == distance - 1:
+                    next_move[index] = direction
+                    break
+        self.distances = distances
+        self.next_move = next_move
+
+    def hint(self, position=None):
+        """
+        Returns the direction of the next correct move from the given position
+        (defaults to the player), or None if it is the target.
+        """
+        x, y = position or self.player
+        direction = self.next_move[x + y * self.width]
+        if direction == NO_MOVE:
+            return None
+        return DIRECTIONS[direction][0]
+
+    def build_dash_table(self):
+        """
+        Precomputes where a dash ends from every cell in every direction. A
+        dash follows the corridor, turns included, and stops at the first
+        junction, dead end or the target. Stored as a flat array of cell
+        indices, four slots per cell, -1 where there is a wall.
+        """
+        unknown = -2
+        exits = [self._exits(index) for index in range(len(self.walls))]
+        x, y = self.target
+        target = x + y * self.width
+        dash_to = array('i', [-1]) * (4 * len(self.walls))
+        for index, cell_exits in enumerate(exits):
+            for direction, _ in cell_exits:
+                dash_to[4 * index + direction] = unknown
+
+        for index, cell_exits in enumerate(exits):
+            for direction, neighbor in cell_exits:
+                if dash_to[4 * index + direction] != unknown:
+                    continue
+                # Walk the corridor, remembering every slot along the way as
+                # they all end up in the same place.
+                path = [4 * index + direction]
+                while len(exits[neighbor]) == 2 and neighbor != target:
+                    # Directions come in opposite pairs, see DIRECTIONS.
+                    direction, following = [e for e in exits[neighbor] if e[0] != direction ^ 1][0]
+                    slot = 4 * neighbor + direction
+                    if dash_to[slot] != unknown:
+                        neighbor = dash_to[slot]
+                        break
+                    path.append(slot)
+                    neighbor = following
+                for slot in path:
+                    dash_to[slot] = neighbor
+        self.dash_to = dash_to
+
+    def dash(self, position, direction):
+        """
+        Returns where a dash from the given position in the given direction
+        ends, which is the same position if there is a wall in the way.
+        """
+        x, y = position
+        index = self.dash_to[4 * (x + y * self.width) + DIRECTION_INDEX[direction]]
+        if index < 0:
+            return position
+        return self._position(index)
+
+    def move(self, position, direction, dashing=False):
+        """
+        Returns where a move from the given position in the given direction
+        ends, dashing or going a single cell.
+        """
+        if dashing:
+            return self.dash(position, direction)
+        x, y = position
+        if self.walls[x + y * self.width] & WALL_BITS[direction]:
+            return position
+        _, difx, dify = DIRECTIONS[DIRECTION_INDEX[direction]]
+        return (x + difx, y + dify)
+
+    def rating(self):
+        """
+        Returns the length of the shortest path from the player to the target
+        and the number of dead ends in the maze.
+        """
+        x, y = self.player
+        # Masks with exactly three walls standing.
+        dead_ends = sum(self.walls.count(mask) for mask in (7, 11, 13, 14))
+        return Rating(self.distances[x + y * self.width], dead_ends)
+
+    def to_bytes(self):
+        """
+        Returns a compact binary snapshot of the maze: its sizes, the player,
+        the target, the seed and the walls packed at 4 bits per cell.
+        """
+        flags = SNAPSHOT_HAS_SEED if self.seed is not None else 0
+        header = SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, flags,
+                                      self.width, self.height,
+                                      self.player[0], self.player[1],
+                                      self.target[0], self.target[1],
+                                      self.seed or 0)
+        walls = bytes(self.walls)
+        if len(walls) % 2:
+            walls += b'\0'
+        # Masks never exceed 4 bits, so shifting the odd cells as one big
+        # integer moves each of them into the high half of its own byte.
+        low = int.from_bytes(walls[0::2], 'little')
+        high = int.from_bytes(walls[1::2], 'little')
+        return header + (low | high << 4).to_bytes(len(walls) // 2, 'little')
 
     @staticmethod
-    def generate(width=20, height=10):
+    def from_bytes(data):
         """
-        Returns a new random perfect maze with the given sizes.
+        Returns the maze stored in a snapshot made by `Maze.to_bytes`, with
+        its distance field and dash table rebuilt.
         """
-        m = Maze(width, height)
+        (magic, version, flags, width, height,
+         player_x, player_y, target_x, target_y, seed) = SNAPSHOT_HEADER.unpack_from(data)
+        if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+            raise ValueError('Not a maze snapshot')
+        size = width * height
+        packed = data[SNAPSHOT_HEADER.size:SNAPSHOT_HEADER.size + (size + 1) // 2]
+        if len(packed) != (size + 1) // 2:
+            raise ValueError('Truncated maze snapshot')
+        value = int.from_bytes(packed, 'little')
+        nibbles = int.from_bytes(b'\x0f' * len(packed), 'little')
+        walls = bytearray(len(packed) * 2)
+        walls[0::2] = (value & nibbles).to_bytes(len(packed), 'little')
+        walls[1::2] = (value >> 4 & nibbles).to_bytes(len(packed), 'little')
+        del walls[size:]
+
+        m = Maze(width, height, (player_x, player_y), (target_x, target_y),
+                 seed=seed if flags & SNAPSHOT_HAS_SEED else None)
+        m.walls = walls
+        m.solve()
+        m.build_dash_table()
+        return m
+
+    @staticmethod
+    def generate(width=20, height=10, seed=None):
+        """
+        Returns a new random perfect maze with the given sizes, the player and
+        the target as far apart as possible.
+        """
+        m = Maze(width, height, seed=seed)
         m.randomize()
+        m.place_endpoints()
+        m.solve()
+        m.build_dash_table()
         return m
         
 ############################
@@ -278,20 +548,222 @@ class Maze(object):
 ############################
 
 import asyncio
+import os
+import logging
+import discord
 from discord.ext import commands
+from .utils import checks
+from cogs.utils.dataIO import dataIO
 from cogs.utils.chat_formatting import box
 from __main__ import send_cmd_help
-from collections import OrderedDict
+from collections import OrderedDict, deque
+
+FILE_PATH = "data/maze/settings.json"
+SESSIONS_PATH = "data/maze/sessions.bin"
+log = logging.getLogger('red.maze')
+
+DEFAULT_POOL_DEPTH = 3
+MAX_POOL_DEPTH = 20
+# Only the most recently requested board sizes are kept warm.
+MAX_POOLED_SIZES = 8
+# Minimum seconds between two edits of the same game message.
+EDIT_INTERVAL = 1.0
+INACTIVITY_TIMEOUT = 120
+# Seconds between two checkpoints of the running games.
+CHECKPOINT_INTERVAL = 30
+
+# Checkpoint file: magic and number of sessions, then for each session its
+# channel, message and author ids, dash mode and snapshot length, followed by
+# the maze snapshot itself.
+SESSIONS_HEADER = struct.Struct('<4sI')
+SESSIONS_MAGIC = b'MZSS'
+SESSION_RECORD = struct.Struct('<QQQBI')
+
+CHOICES = OrderedDict((("\u25c0",    (W, -1, 0)),
+                       ("\U0001f53c", (N, 0, -1)),
+                       ("\U0001f53d", (S, 0, 1)),
+                       ("\u25b6",     (E, 1, 0)),
+                       ("\U0001f4a1", "hint"),
+                       ("\u23e9",     "dash"),
+                       ("\u274c",     "exit")))
+ARROWS = {choice[0]: em for em, choice in CHOICES.items() if isinstance(choice, tuple)}
+# Hints would spoil a race.
+RACE_CHOICES = OrderedDict((em, choice) for em, choice in CHOICES.items() if choice != "hint")
+# Marker of each racer, in order.
+RACE_MARKERS = "123456789"
+
+
+def _new_seed():
+    return random.getrandbits(32)
+
+
+def _build_maze(width, height, seed):
+    """
+    Generates and pre-renders a maze. Runs in an executor, away from the event
+    loop, so it must not touch anything asyncio related.
+    """
+    maze = Maze.generate(width, height, seed)
+    maze.wall_rows()
+    return maze
+
+
+def _maze_message(maze, header=""):
+    if header:
+        return header + "\n" + box(maze)
+    return box(maze)
+
+
+def _race_legend(racers):
+    return ", ".join("{}: {}".format(marker, racer.display_name)
+                     for racer, marker in zip(racers, RACE_MARKERS))
+
+
+def write_checkpoint(path, sessions):
+    """Atomically writes the given sessions to a checkpoint file."""
+    records = []
+    for session in sessions:
+        snapshot = session.maze.to_bytes()
+        records.append(SESSION_RECORD.pack(int(session.message.channel.id), int(session.message.id),
+                                           int(session.author.id), session.dashing, len(snapshot)))
+        records.append(snapshot)
+    temp_path = path + '.tmp'
+    with open(temp_path, 'wb') as f:
+        f.write(SESSIONS_HEADER.pack(SESSIONS_MAGIC, len(records) // 2))
+        f.writelines(records)
+    os.replace(temp_path, path)
+
+
+def read_checkpoint(path):
+    """
+    Returns (channel id, message id, author id, dashing, maze) for each session
+    in a checkpoint file, or nothing if there is no valid checkpoint.
+    """
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+    except FileNotFoundError:
+        return []
+    try:
+        magic, count = SESSIONS_HEADER.unpack_from(data)
+        if magic != SESSIONS_MAGIC:
+            raise ValueError('Not a maze checkpoint')
+        offset = SESSIONS_HEADER.size
+        sessions = []
+        for _ in range(count):
+            channel_id, message_id, author_id, dashing, length = SESSION_RECORD.unpack_from(data, offset)
+            offset += SESSION_RECORD.size
+            maze = Maze.from_bytes(data[offset:offset + length])
+            offset += length
+            sessions.append((str(channel_id), str(message_id), str(author_id), bool(dashing), maze))
+        return sessions
+    except (struct.error, ValueError):
+        log.warning('Ignoring corrupted maze checkpoint %s' % path, exc_info=True)
+        return []
+
+
+class MazePool:
+    """
+    Keeps a few pre-generated mazes ready for each recently used board size,
+    refilled in the background by the loop's default executor.
+    """
+
+    def __init__(self, loop, depth=DEFAULT_POOL_DEPTH):
+        self.loop = loop
+        self.depth = depth
+        self.pools = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self._wanted = asyncio.Event()
+        self._task = None
+
+    def start(self, sizes=()):
+        for size in sizes:
+            self._track(size)
+        self._wanted.set()
+        self._task = self.loop.create_task(self._refill())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def set_depth(self, depth):
+        self.depth = depth
+        for pool in self.pools.values():
+            while len(pool) > depth:
+                pool.pop()
+        self._wanted.set()
+
+    def _track(self, size):
+        """Returns the pool for the given size, marking it as recently used."""
+        if size in self.pools:
+            self.pools.move_to_end(size)
+        else:
+            self.pools[size] = deque()
+            while len(self.pools) > MAX_POOLED_SIZES:
+                self.pools.popitem(last=False)
+        return self.pools[size]
+
+    def pop(self, width, height):
+        """Returns a ready maze of the given size, or None if there is none."""
+        pool = self._track((width, height))
+        self._wanted.set()
+        if pool:
+            self.hits += 1
+            return pool.popleft()
+        self.misses += 1
+        return None
+
+    async def get(self, width, height):
+        """Returns a maze of the given size, generating one off-loop if needed."""
+        maze = self.pop(width, height)
+        if maze is None:
+            maze = await self.loop.run_in_executor(None, _build_maze,
+                                                   width, height, _new_seed())
+        return maze
+
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    async def _refill(self):
+        while True:
+            await self._wanted.wait()
+            self._wanted.clear()
+            for (width, height), pool in list(self.pools.items()):
+                try:
+                    while len(pool) < self.depth:
+                        maze = await self.loop.run_in_executor(None, _build_maze,
+                                                               width, height, _new_seed())
+                        pool.append(maze)
+                except Exception:
+                    log.exception("Could not build a %dx%d maze, no longer pooling it" % (width, height))
+                    self.pools.pop((width, height), None)
+
 
 class MazeCog:
     def __init__(self, bot):
         self.bot = bot
-        
+        self.settings = dataIO.load_json(FILE_PATH)
+        self.pool = MazePool(bot.loop, self.settings.get("pool_depth", DEFAULT_POOL_DEPTH))
+        self.pool.start([(20, 10)])
+        self.dispatcher = ReactionDispatcher()
+        self.sessions = SessionManager(bot, self.dispatcher)
+        self.tasks = [bot.loop.create_task(self.restore_sessions()),
+                      bot.loop.create_task(self.checkpoint_sessions())]
+
+    def __unload(self):
+        for task in self.tasks:
+            task.cancel()
+        self.pool.stop()
+        write_checkpoint(SESSIONS_PATH, self.sessions.checkpointed())
+        self.sessions.stop()
+
     @commands.command(pass_context=True, name="maze")
     async def play_maze(self, ctx, width: int=20, height: int=10):
         """Create an interactive maze just for you!
         Maximum width of 20 and maximum height of 10."""
-        if width > 20 or height > 10:
+        if not (1 <= width <= 20 and 1 <= height <= 10):
             await send_cmd_help(ctx)
             return
         
@@ -299,136 +771,457 @@ class MazeCog:
             await self.bot.say("That's an insta-win for you! Good job buddy.")
         
         author = ctx.message.author
-        maze = Maze.generate(width, height)
-        msgobj = await self.bot.say(box(maze))
-        choices = OrderedDict((("\u25c0",    (W, -1, 0)),
-                               ("\U0001f53c", (N, 0, -1)),
-                               ("\U0001f53d", (S, 0, 1)),
-                               ("\u25b6",     (E, 1, 0)),
-                               ("\u274c",     "exit")))
-        
-        for em in choices:
-            await self.bot.add_reaction(msgobj, em)
-        
-        choice = True
-        while maze.player != maze.target:
-            choice = await wait_for_interaction(self.bot, msgobj, author, choices)
-            if choice is None:
-                await self.bot.say("Inactive for 2 minutes, game has concluded.")
-                for em in reversed(choices):
-                    await self.bot.remove_reaction(msgobj, em, ctx.message.server.me)
-                return
-            if choice == "exit":
-                await self.bot.delete_message(msgobj)
-                return
-            direction, difx, dify = choice
+        maze = await self.pool.get(width, height)
+        rating = maze.rating()
+        header = "Shortest path: {} moves, {} dead ends.".format(*rating)
+        msgobj = await self.bot.say(_maze_message(maze, header))
+
+        session = self.sessions.start(maze, msgobj, author)
+        await self._conclude(session)
+
+    @commands.command(pass_context=True, no_pm=True, name="mazerace")
+    async def race_maze(self, ctx, *racers: discord.Member):
+        """Race the given members through the same maze!
+        Everyone moves their own number, the first one to reach the $ wins.
+        Up to 9 racers, including you."""
+        author = ctx.message.author
+        racers = [author] + [racer for racer in OrderedDict.fromkeys(racers) if racer != author]
+        if len(racers) < 2 or len(racers) > len(RACE_MARKERS):
+            await send_cmd_help(ctx)
+            return
+
+        maze = await self.pool.get(20, 10)
+        # Drawn like RaceSession.content, with every racer on the start
+        markers = [(maze.target, "$")] + [(maze.player, marker) for marker in RACE_MARKERS[:len(racers)]]
+        msgobj = await self.bot.say(_race_legend(racers) + "\n" + box(maze.render(markers)))
+        session = self.sessions.start_race(maze, msgobj, author, racers)
+        await self._conclude(session)
+
+    async def _conclude(self, session):
+        """Waits for a game to end and announces how it ended."""
+        channel = session.message.channel
+        try:
+            outcome = await session.task
+        except asyncio.CancelledError:
+            # The cog is being unloaded, the game lives on in the checkpoint.
+            return
+        if outcome == "timeout":
+            await self.bot.send_message(channel, "Inactive for 2 minutes, game has concluded.")
+            for em in reversed(session.choices):
+                await self.bot.remove_reaction(session.message, em, channel.server.me)
+        elif outcome == "exit":
+            await self.bot.delete_message(session.message)
+        elif outcome == "lost":
+            return
+        else:
+            await self.bot.send_message(channel, session.win_message())
+
+    async def restore_sessions(self):
+        """Resumes the games saved in the last checkpoint."""
+        await self.bot.wait_until_ready()
+        for channel_id, message_id, author_id, dashing, maze in read_checkpoint(SESSIONS_PATH):
+            try:
+                await self._restore_session(channel_id, message_id, author_id, dashing, maze)
+            except Exception:
+                log.warning('Could not restore the maze game of message %s' % message_id, exc_info=True)
+        log.debug('Restored %d maze games' % len(self.sessions.sessions))
+
+    async def _restore_session(self, channel_id, message_id, author_id, dashing, maze):
+        channel = self.bot.get_channel(channel_id)
+        # Games in DMs aren't checkpointed, older checkpoints may still have some.
+        if channel is None or channel.is_private:
+            return
+        author = channel.server.get_member(author_id)
+        if author is None:
+            return
+        try:
+            message = await self.bot.get_message(channel, message_id)
+        except discord.HTTPException:
+            return
+        # Reaction events are only dispatched for cached messages.
+        self.bot.messages.append(message)
+        session = self.sessions.start(maze, message, author, dashing=dashing)
+        self.bot.loop.create_task(self._conclude(session))
+
+    async def checkpoint_sessions(self):
+        while True:
+            await asyncio.sleep(CHECKPOINT_INTERVAL)
+            if self.sessions.changed:
+                self.sessions.changed = False
+                write_checkpoint(SESSIONS_PATH, self.sessions.checkpointed())
+
+    @commands.group(pass_context=True)
+    @checks.is_owner()
+    async def mazeset(self, ctx):
+        """Maze settings and statistics."""
+        if ctx.invoked_subcommand is None:
+            await send_cmd_help(ctx)
+
+    @mazeset.command(name="pooldepth")
+    async def mazeset_pooldepth(self, depth: int):
+        """Sets how many mazes are kept ready for each board size."""
+        if not 0 <= depth <= MAX_POOL_DEPTH:
+            await self.bot.say("The pool depth must be between 0 and {}.".format(MAX_POOL_DEPTH))
+            return
+        self.settings["pool_depth"] = depth
+        dataIO.save_json(FILE_PATH, self.settings)
+        self.pool.set_depth(depth)
+        await self.bot.say("Pool depth set to {}.".format(depth))
+
+    @mazeset.command(name="stats")
+    async def mazeset_stats(self):
+        """Shows maze pool statistics."""
+        pool = self.pool
+        lines = ["Pool depth: {}".format(pool.depth),
+                 "Hits: {}, misses: {} ({:.0%} hit rate)".format(pool.hits, pool.misses, pool.hit_rate())]
+        for (width, height), mazes in reversed(pool.pools.items()):
+            lines.append("{}x{}: {} ready".format(width, height, len(mazes)))
+        sessions = self.sessions
+        lines += ["Active games: {}".format(len(sessions.sessions)),
+                  "Inputs: {}, edits: {} ({} saved)".format(sessions.inputs, sessions.edits,
+                                                            sessions.inputs - sessions.edits),
+                  "Input to display latency: {:.2f}s average, {:.2f}s max".format(
+                      sessions.average_latency(), sessions.max_latency)]
+        await self.bot.say(box('\n'.join(lines)))
+
+
+    async def on_reaction_add(self, reaction, user):
+        self.dispatcher.dispatch(reaction, user)
 
-            current_cell = maze[maze.player]
-            if direction not in current_cell:
-                maze.player = (maze.player[0] + difx, maze.player[1] + dify)
-            msgobj = await self.bot.edit_message(msgobj, box(maze))
-        await self.bot.say("You win!")
-        
-        
     async def on_reaction_remove(self, reaction, user):
-        """Handles watching for reactions for wait_for_reaction_remove"""
-        for event in _reaction_remove_events:
-            if (event and not event.is_set() and
-                event.check(reaction, user) and
-                reaction.emoji in event.emojis):
-                event.set(reaction)
-        
+        self.dispatcher.dispatch(reaction, user)
+
+
+class GameSession:
+    """
+    A running maze game. Input is applied to the maze as soon as it arrives,
+    while a single renderer edits the message at most once per EDIT_INTERVAL,
+    always with the latest state.
+    """
+
+    choices = CHOICES
+    # Whether the game is saved in the checkpoints.
+    checkpointed = True
+
+    def __init__(self, manager, maze, message, author, dashing=False):
+        self.manager = manager
+        self.maze = maze
+        self.message = message
+        self.author = author
+        self.header = ""
+        self.dashing = dashing
+        self.closing = False
+        self.task = None
+        self._dirty = asyncio.Event()
+        # Loop time of the oldest input the message doesn't show yet.
+        self._pending_since = None
+        self._renderer = None
+        self._listener = None
+        # Whether the message could no longer be edited, e.g. it was deleted.
+        self.lost = False
+
+    def players(self):
+        return (self.author,)
+
+    def position(self, user):
+        return self.maze.player
+
+    def move_to(self, user, position):
+        self.maze.player = position
+
+    def is_dashing(self, user):
+        return self.dashing
+
+    def toggle_dash(self, user):
+        self.dashing = not self.dashing
+        return self.dashing
+
+    def markers(self):
+        return ((self.maze.target, "$"), (self.maze.player, "@"))
+
+    def describe(self, user, text):
+        """Returns the header shown after a press of the given user."""
+        return text
+
+    def content(self):
+        rendered = box(self.maze.render(self.markers()))
+        if self.header:
+            return self.header + "\n" + rendered
+        return rendered
+
+    def apply(self, choice, user):
+        """Applies a single direction, hint or dash toggle press to the game state."""
+        maze = self.maze
+        if choice == "hint":
+            self.header = self.describe(user, "Hint: go {}".format(ARROWS[maze.hint(self.position(user))]))
+        elif choice == "dash":
+            dashing = self.toggle_dash(user)
+            self.header = self.describe(user, "Dash mode {}.".format("on" if dashing else "off"))
+        else:
+            direction, _, _ = choice
+            self.move_to(user, maze.move(self.position(user), direction, self.is_dashing(user)))
+            self.header = ""
+        self.manager.inputs += 1
+        self.manager.changed = True
+        if self._pending_since is None:
+            self._pending_since = self.manager.loop.time()
+        self._dirty.set()
+
+    def finished(self):
+        return self.maze.player == self.maze.target
+
+    def win_message(self):
+        return "You win!"
+
+    async def run(self):
+        """
+        Plays the game until it is won, exited, abandoned or its message is
+        lost, and returns "win", "exit", "timeout" or "lost" respectively.
+        """
+        loop = self.manager.loop
+        listener = self._listener = self.manager.dispatcher.listen(loop, self.message, self.players(),
+                                                                   self.choices)
+        self._renderer = loop.create_task(self._render())
+        try:
+            for em in self.choices:
+                await self.manager.bot.add_reaction(self.message, em)
+
+            while not self.finished():
+                press = await listener.get(timeout=INACTIVITY_TIMEOUT)
+                if press is None:
+                    return "lost" if self.lost else "timeout"
+                emoji, user = press
+                choice = self.choices[emoji]
+                if choice == "exit":
+                    if user.id == self.author.id:
+                        return "exit"
+                    continue
+                self.apply(choice, user)
+            await self._close()
+            return "win"
+        finally:
+            self.manager.dispatcher.close(listener)
+            self._renderer.cancel()
+            self.manager.remove(self)
+
+    async def _close(self):
+        """Waits for the renderer to show the final state and stop."""
+        self.closing = True
+        self._dirty.set()
+        await self._renderer
+
+    async def _render(self):
+        loop = self.manager.loop
+        while True:
+            await self._dirty.wait()
+            self._dirty.clear()
+            if self._pending_since is not None:
+                pending_since, self._pending_since = self._pending_since, None
+                try:
+                    self.message = await self.manager.bot.edit_message(self.message, self.content())
+                except discord.HTTPException:
+                    log.warning('Could not edit maze message %s, ending its game' % self.message.id,
+                                exc_info=True)
+                    self.lost = True
+                    self._listener.interrupt()
+                    return
+                self.manager.edited(loop.time() - pending_since)
+            if self.closing:
+                return
+            await asyncio.sleep(EDIT_INTERVAL)
+
+
+class RaceSession(GameSession):
+    """
+    Several players racing to the target of one maze, each with their own
+    marker and dash mode. Only the one who started the race can end it.
+    """
+
+    choices = RACE_CHOICES
+    checkpointed = False
+
+    def __init__(self, manager, maze, message, author, racers):
+        super().__init__(manager, maze, message, author)
+        self.racers = racers
+        self.markers_by_id = {racer.id: marker for racer, marker in zip(racers, RACE_MARKERS)}
+        self.positions = {racer.id: maze.player for racer in racers}
+        self.dashers = set()
+        self.winner = None
+        self.legend = _race_legend(racers)
+
+    def players(self):
+        return self.racers
+
+    def position(self, user):
+        return self.positions[user.id]
+
+    def move_to(self, user, position):
+        self.positions[user.id] = position
+        if position == self.maze.target and self.winner is None:
+            self.winner = user
+
+    def is_dashing(self, user):
+        return user.id in self.dashers
+
+    def toggle_dash(self, user):
+        self.dashers ^= {user.id}
+        return user.id in self.dashers
+
+    def markers(self):
+        markers = [(self.maze.target, "$")]
+        markers.extend((position, self.markers_by_id[racer_id])
+                       for racer_id, position in self.positions.items())
+        return markers
+
+    def describe(self, user, text):
+        return "{}: {}".format(user.display_name, text)
+
+    def content(self):
+        return self.legend + "\n" + super().content()
+
+    def finished(self):
+        return self.winner is not None
+
+    def win_message(self):
+        return "{} wins the race!".format(self.winner.mention)
+
+
+class SessionManager:
+    """Tracks every running game and how much editing the debouncing saves."""
+
+    def __init__(self, bot, dispatcher):
+        self.bot = bot
+        self.loop = bot.loop
+        self.dispatcher = dispatcher
+        self.sessions = {}
+        # Whether the games changed since the last checkpoint.
+        self.changed = False
+        self.inputs = 0
+        self.edits = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+
+    def start(self, maze, message, author, dashing=False):
+        """Starts playing a game in its own task, stored as `session.task`."""
+        return self._add(GameSession(self, maze, message, author, dashing))
+
+    def start_race(self, maze, message, author, racers):
+        """Starts a race between the given members, see `start`."""
+        return self._add(RaceSession(self, maze, message, author, racers))
+
+    def _add(self, session):
+        self.sessions[session.message.id] = session
+        self.changed = True
+        session.task = self.loop.create_task(session.run())
+        return session
+
+    def remove(self, session):
+        self.sessions.pop(session.message.id, None)
+        self.changed = True
+
+    def checkpointed(self):
+        # A DM channel can't be looked up again after a restart.
+        return [session for session in self.sessions.values()
+                if session.checkpointed and not session.message.channel.is_private]
+
+    def stop(self):
+        for session in list(self.sessions.values()):
+            session.task.cancel()
+
+    def edited(self, latency):
+        self.edits += 1
+        self.total_latency += latency
+        self.max_latency = max(self.max_latency, latency)
+
+    def average_latency(self):
+        return self.total_latency / self.edits if self.edits else 0.0
+
+
 ##############
 # EMOJI SHIT #
 ##############
-     
-_reaction_remove_events = set()
 
-class ReactionRemoveEvent(asyncio.Event):
-    def __init__(self, emojis, author, check=None):
-        super().__init__()
-        self.emojis = emojis
-        self.author = author
-        self.reaction = None
-        self.check = check
-
-    def set(self, reaction):
-        self.reaction = reaction
-        return super().set()
-    
-async def wait_for_result(task, converter):
-    """await the task call and return its results parsed through the converter"""
-    # why did I do this?
-    return converter(await task)
-
-async def wait_for_first_response(tasks, converters):
-    """given a list of unawaited tasks and non-coro result parsers to be called on the results,
-    this function returns the 1st result that is returned and converted
-    if it is possible for 2 tasks to complete at the same time,
-    only the 1st result deteremined by asyncio.wait will be returned
-    returns None if none successfully complete
-    returns 1st error raised if any occur (probably)
+class ReactionListener:
+    """
+    Long-lived listener for the reactions on a single message. Reactions are
+    toggles, so both adding and removing one counts as a press.
     """
-    primed = [wait_for_result(t, c) for t, c in zip(tasks, converters)]
-    done, pending = await asyncio.wait(primed, return_when=asyncio.FIRST_COMPLETED)
-    for p in pending:
-        p.cancel()
 
-    try:
-        return done.pop().result()
-    except NotImplementedError as e:
-        raise e
-    except:
-        return None
-        
-async def wait_for_interaction(bot, msg, author, choices,
-                               timeout=120):
-    """waits for a reaction add/remove"""
+    def __init__(self, loop, message, users, emojis):
+        self.loop = loop
+        self.message = message
+        self.user_ids = {user.id for user in users}
+        self.emojis = emojis
+        self.queue = asyncio.Queue()
 
-    emojis = tuple(choices.keys())
+    def feed(self, reaction, user):
+        if user.id in self.user_ids and reaction.emoji in self.emojis:
+            self.queue.put_nowait((reaction.emoji, user))
 
-    def rcheck(reaction, user):
-        return True
+    async def get(self, timeout=None):
+        """
+        Returns the next (emoji, user) press, or None if there was none for
+        `timeout` seconds or the listener was interrupted. The timeout is a timer handle pushing a sentinel
+        through the queue, so no task is created per call.
+        """
+        if timeout is None:
+            while True:
+                item = await self.queue.get()
+                if item is None or isinstance(item, tuple):
+                    return item
+        sentinel = object()
+        handle = self.loop.call_later(timeout, self.queue.put_nowait, sentinel)
+        try:
+            while True:
+                item = await self.queue.get()
+                if item is sentinel or item is None:
+                    return None
+                # Sentinels of earlier calls that fired late are skipped.
+                if isinstance(item, tuple):
+                    return item
+        finally:
+            handle.cancel()
 
-    kwreact = {'timeout': timeout, 'message': msg,
-               'emoji': emojis, 'check': rcheck,
-               'user': author}
+    def interrupt(self):
+        """Makes the pending or next get return None right away."""
+        self.queue.put_nowait(None)
 
-    tasks = (bot.wait_for_reaction(**kwreact),
-             wait_for_reaction_remove(bot, **kwreact))
 
-    def mojichoice(r):
-        if not r:
-            return None
-        return choices[r.reaction.emoji]
+class ReactionDispatcher:
+    """Routes reaction events to the listener of their message, if any."""
 
-    converters = (mojichoice, mojichoice)
-    return await wait_for_first_response(tasks, converters)
+    def __init__(self):
+        self.listeners = {}
+
+    def listen(self, loop, message, users, emojis):
+        listener = ReactionListener(loop, message, users, emojis)
+        self.listeners[message.id] = listener
+        return listener
+
+    def close(self, listener):
+        if self.listeners.get(listener.message.id) is listener:
+            del self.listeners[listener.message.id]
+
+    def dispatch(self, reaction, user):
+        listener = self.listeners.get(reaction.message.id)
+        if listener is not None:
+            listener.feed(reaction, user)
+
+
+def check_folder():
+    folder = os.path.dirname(FILE_PATH)
+    if not os.path.exists(folder):
+        log.debug('Creating folder: %s' % folder)
+        os.makedirs(folder)
+
+
+def check_file():
+    if dataIO.is_valid_json(FILE_PATH) is False:
+        log.debug('Creating json: %s' % os.path.basename(FILE_PATH))
+        dataIO.save_json(FILE_PATH, {"pool_depth": DEFAULT_POOL_DEPTH})
 
 
-async def wait_for_reaction_remove(bot, emoji=None, *, user=None,
-                                   timeout=None, message=None, check=None):
-    """Waits for a reaction to be removed by a user from a message within a time period.
-    Made to act like other discord.py wait_for_* functions but is not fully implemented.
-    Because of that, wait_for_reaction_remove(self, emoji: list, user, message, timeout=None)
-    is a better representation of this function's def
-    returns the actual event or None if timeout
-    """
-    if not emoji or isinstance(emoji, str):
-        raise NotImplementedError("wait_for_reaction_remove(self, emoji, "
-                                  "message, user=None, timeout=None, "
-                                  "check=None) is a better representation "
-                                  "of this function definition")
-    remove_event = ReactionRemoveEvent(emoji, user, check=check)
-    _reaction_remove_events.add(remove_event)
-    done, pending = await asyncio.wait([remove_event.wait()],
-                                       timeout=timeout)
-    still_in = remove_event in _reaction_remove_events
-    _reaction_remove_events.remove(remove_event)
-    try:
-        return done.pop().result() and still_in and remove_event
-    except:
-        return None
-    
 def setup(bot):
+    check_folder()
+    check_file()
     bot.add_cog(MazeCog(bot))
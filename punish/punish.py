@@ -1,12 +1,19 @@
 import discord
 from discord.ext import commands
 from .utils import checks
+import asyncio
+import heapq
+import json
 import logging
 from cogs.utils.dataIO import dataIO
 import os
 import time
 import re
-from cogs.utils.chat_formatting import box
+import sqlite3
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from cogs.utils.chat_formatting import box, pagify
+from __main__ import send_cmd_help
 
 try:
     from tabulate import tabulate
@@ -25,6 +32,13 @@ UNIT_SUF_TABLE = {'sec': (1, ''),
                   }
 DEFAULT_TIMEOUT = '30m'
 PURGE_MESSAGES = 1  # for cpunish
+GUILD_CONCURRENCY = 5  # concurrent API calls per server
+COMPACT_EVERY = 1000  # journal records between two snapshots
+STORYTIME_PATH = 'data/punish/storytime.json'  # ids of the members storytime muted, per server
+HISTORY_WINDOW = '30d'  # default window of punish history
+HISTORY_SHOWN = 10  # most recent events listed by punish history
+EXPIRY_WINDOW = 2  # seconds, expiries this close together are ended as one batch
+DM_CONCURRENCY = 3  # concurrent unpunish notifications, across all servers
 
 
 def _parse_time(time):
@@ -60,6 +74,271 @@ def _generate_timespec(sec):
     return ', '.join(timespec)
 
 
+def _parse_list_filters(filters):
+    """Returns the moderator id and expiry window of lspunish filters"""
+    moderator = None
+    within = None
+    for f in filters:
+        key, sep, value = f.partition('=')
+        if not (sep and value):
+            raise ValueError('Unknown filter "%s"' % f)
+        if key == 'by':
+            moderator = value.strip('<@!>')
+            if not moderator.isdigit():
+                raise ValueError('Invalid moderator "%s"' % value)
+        elif key == 'within':
+            within = _parse_time(value)
+        else:
+            raise ValueError('Unknown filter "%s"' % f)
+    return moderator, within
+
+
+def _parse_until(duration):
+    """Returns when a punishment of the given duration ends, None for never"""
+    if duration.lower() in ['forever', 'inf', 'infinite']:
+        return None
+    return time.time() + _parse_time(duration)
+
+
+def _resolve_targets(server, targets):
+    """Returns the members matching punish bulk targets, and how many
+    mentions or ids matched no member"""
+    members = []
+    missing = 0
+    now = datetime.utcnow()
+    for target in targets:
+        if target.startswith('joined='):
+            window = timedelta(seconds=_parse_time(target[len('joined='):]))
+            members.extend(m for m in server.members if now - m.joined_at <= window)
+        elif target.startswith('<@&'):
+            role = discord.utils.get(server.roles, id=target[3:-1])
+            if role is None:
+                raise ValueError('Unknown role "%s"' % target)
+            members.extend(m for m in server.members if role in m.roles)
+        else:
+            member_id = target.strip('<@!>')
+            if not member_id.isdigit():
+                raise ValueError('Invalid target "%s"' % target)
+            member = server.get_member(member_id)
+            if member:
+                members.append(member)
+            else:
+                missing += 1
+    # dedupe, keeping order
+    return list(OrderedDict((m.id, m) for m in members).values()), missing
+
+
+class ExpiryScheduler:
+    """Single task calling back with every punishment that is due.
+
+    Keeps a min-heap of (until, server id, member id). Cancelled and
+    rescheduled entries stay in the heap and are skipped when popped, the
+    current deadline of each member being kept in `deadlines`."""
+
+    def __init__(self, loop, callback):
+        self.loop = loop
+        self.callback = callback
+        self.heap = []
+        self.deadlines = {}
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+    def start(self):
+        self._task = self.loop.create_task(self._run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def schedule(self, until, server_id, member_id):
+        """Schedules or reschedules the expiry of a punishment"""
+        key = (server_id, member_id)
+        self.deadlines[key] = until
+        heapq.heappush(self.heap, (until, server_id, member_id))
+        if self.heap[0][0] == until:
+            self._wakeup.set()
+
+    def schedule_many(self, entries):
+        """Schedules many (until, server id, member id) at once"""
+        for until, server_id, member_id in entries:
+            self.deadlines[(server_id, member_id)] = until
+            heapq.heappush(self.heap, (until, server_id, member_id))
+        if entries:
+            self._wakeup.set()
+
+    def cancel(self, server_id, member_id):
+        self.deadlines.pop((server_id, member_id), None)
+
+    def rebuild(self, json):
+        """Rebuilds the heap from the punish data in a single pass"""
+        self.deadlines = {(sid, mid): data['until']
+                          for sid, members in json.items()
+                          for mid, data in members.items() if data['until']}
+        self.heap = [(until, sid, mid) for (sid, mid), until in self.deadlines.items()]
+        heapq.heapify(self.heap)
+        self._wakeup.set()
+
+    def _pop_due(self):
+        """Pops what is due, along with what will be within EXPIRY_WINDOW"""
+        due = []
+        if not self.heap or self.heap[0][0] > time.time():
+            return due
+        now = time.time() + EXPIRY_WINDOW
+        while self.heap and self.heap[0][0] <= now:
+            until, sid, mid = heapq.heappop(self.heap)
+            if self.deadlines.get((sid, mid)) == until:
+                del self.deadlines[(sid, mid)]
+                due.append((sid, mid))
+        return due
+
+    async def _run(self):
+        while True:
+            due = self._pop_due()
+            if due:
+                try:
+                    await self.callback(due)
+                except Exception:
+                    log.exception('Error while ending punishments')
+            # No awaiting between clearing and waiting, so no wakeup is lost
+            self._wakeup.clear()
+            timeout = max(self.heap[0][0] - time.time(), 0) if self.heap else None
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+
+class PunishJournal:
+    """Append-only journal of punishment changes on top of a snapshot.
+
+    Each change costs one appended line. The snapshot is only rewritten,
+    and the journal emptied, every COMPACT_EVERY records or on demand."""
+
+    def __init__(self, snapshot_path, journal_path):
+        self.snapshot_path = snapshot_path
+        self.journal_path = journal_path
+        self.data = {}
+        self.pending = 0
+
+    def load(self):
+        """Returns the snapshot with the journal replayed on top of it"""
+        self.data = compat_load(self.snapshot_path)
+        self.pending = 0
+        if not os.path.exists(self.journal_path):
+            return self.data
+        torn = False
+        with open(self.journal_path, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:  # torn write, nothing after it
+                    torn = True
+                    break
+                self._replay(record)
+                self.pending += 1
+        if torn:
+            # Appending after the torn line would corrupt the next record
+            log.warning('Ignoring truncated punish journal record')
+            self.compact()
+        return self.data
+
+    def _replay(self, record):
+        sid, mid = record['server'], record['member']
+        if record['op'] == 'punish':
+            self.data.setdefault(sid, {})[mid] = {'until': record['until'],
+                                                  'by': record['by'],
+                                                  'reason': record['reason']}
+        elif record['op'] == 'unpunish':
+            self.data.get(sid, {}).pop(mid, None)
+
+    def punished(self, *keys):
+        """Records the current punishment of each (server id, member id)"""
+        records = []
+        for sid, mid in keys:
+            record = {'op': 'punish', 'server': sid, 'member': mid}
+            record.update(self.data[sid][mid])
+            records.append(record)
+        self._append(records)
+
+    def unpunished(self, *keys):
+        """Records the end of the punishment of each (server id, member id)"""
+        self._append([{'op': 'unpunish', 'server': sid, 'member': mid} for sid, mid in keys])
+
+    def _append(self, records):
+        if not records:
+            return
+        with open(self.journal_path, 'a', encoding='utf-8') as f:
+            f.write(''.join(json.dumps(r) + '\n' for r in records))
+        self.pending += len(records)
+        if self.pending >= COMPACT_EVERY:
+            self.compact()
+
+    def compact(self):
+        """Writes the snapshot and empties the journal"""
+        # Replaying the journal on the new snapshot is harmless if we stop
+        # between the two steps.
+        dataIO.save_json(self.snapshot_path, self.data)
+        open(self.journal_path, 'w').close()
+        self.pending = 0
+
+
+class PunishHistory:
+    """SQLite store of every punishment event, for audits.
+
+    Events are (server id, member id, moderator id, action, time, until,
+    reason), the action being one of punish, unpunish, expire or rejoin."""
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS events (
+            id INTEGER PRIMARY KEY,
+            server TEXT NOT NULL,
+            member TEXT NOT NULL,
+            moderator TEXT,
+            action TEXT NOT NULL,
+            at REAL NOT NULL,
+            until REAL,
+            reason TEXT
+        );
+        CREATE INDEX IF NOT EXISTS events_member ON events (server, member, at);
+        CREATE INDEX IF NOT EXISTS events_moderator ON events (server, moderator, at);
+        CREATE INDEX IF NOT EXISTS events_time ON events (server, at);
+        """
+
+    def __init__(self, path):
+        self.db = sqlite3.connect(path)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.executescript(self.SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def record(self, action, *events):
+        """Records (server id, member id, moderator id, until, reason) events"""
+        if not events:
+            return
+        now = time.time()
+        with self.db:
+            self.db.executemany('INSERT INTO events (server, member, moderator, action, at, until, reason) '
+                                'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                [(sid, mid, by, action, now, until, reason)
+                                 for sid, mid, by, until, reason in events])
+
+    def counts(self, server_id, member_id, since=None):
+        """Returns {action: count} of a member's events since a time"""
+        rows = self.db.execute('SELECT action, COUNT(*) FROM events '
+                               'WHERE server = ? AND member = ? AND at >= ? GROUP BY action',
+                               (server_id, member_id, since or 0))
+        return dict(rows)
+
+    def recent(self, server_id, member_id, since=None, limit=HISTORY_SHOWN):
+        """Returns a member's latest (action, time, moderator id, until, reason)"""
+        return self.db.execute('SELECT action, at, moderator, until, reason FROM events '
+                               'WHERE server = ? AND member = ? AND at >= ? ORDER BY at DESC LIMIT ?',
+                               (server_id, member_id, since or 0, limit)).fetchall()
+
+
 class Punish:
     """Adds the ability to punish users."""
 
@@ -77,12 +356,22 @@ class Punish:
 
     def __init__(self, bot):
         self.bot = bot
-        self.location = 'data/punish/settings.json'
-        self.json = compat_load(self.location)
-        self.handles = {}
+        self.journal = PunishJournal('data/punish/settings.json', 'data/punish/journal.jsonl')
+        self.json = self.journal.load()
+        self.history = PunishHistory('data/punish/history.db')
+        self.scheduler = ExpiryScheduler(bot.loop, self._expire)
+        self.limiters = {}
         self.role_name = 'Bad Boy'
+        self.roles = {}  # server id -> punish role, see _get_role
+        self.dm_limiter = asyncio.Semaphore(DM_CONCURRENCY)
+        self.storytime_muted = {sid: set(ids) for sid, ids in dataIO.load_json(STORYTIME_PATH).items()}
         bot.loop.create_task(self.on_load())
 
+    def __unload(self):
+        self.scheduler.stop()
+        self.journal.compact()
+        self.history.close()
+
     @commands.command(pass_context=True, no_pm=True)
     @checks.mod_or_permissions(manage_messages=True)
     async def cpunish(self, ctx, user: discord.Member, duration: str=None, *, reason: str=None):
@@ -120,11 +409,12 @@ class Punish:
         }
 
         await self.bot.add_roles(user, role)
-        dataIO.save_json(self.location, self.json)
+        self.journal.punished((server.id, user.id))
+        self.history.record('punish', (server.id, user.id, ctx.message.author.id, timestamp, reason))
 
-        # schedule callback for role removal
+        # schedule role removal
         if duration:
-            self.schedule_unpunish(duration, user, reason)
+            self.scheduler.schedule(timestamp, server.id, user.id)
 
         def is_user(m):
             return m == ctx.message or m.author == user
@@ -136,7 +426,7 @@ class Punish:
             await self.bot.send_message(ctx.message.channel, "Punishment set, but I need"
                                         "permissions to manage messages to clean up.")
 
-    @commands.command(pass_context=True, no_pm=True)
+    @commands.group(pass_context=True, no_pm=True, invoke_without_command=True)
     @checks.mod_or_permissions(manage_messages=True)
     async def punish(self, ctx, user: discord.Member, duration: str=None, *, reason: str=None):
         """Puts a user into timeout for a specified time period, with an optional reason.
@@ -184,57 +474,202 @@ class Punish:
 
         await self.bot.add_roles(user, role)
         await self.bot.server_voice_state(user, mute=True, deafen=True)
-        dataIO.save_json(self.location, self.json)
+        self.journal.punished((server.id, user.id))
+        self.history.record('punish', (server.id, user.id, ctx.message.author.id, timestamp, reason))
 
-        # schedule callback for role removal
+        # schedule role removal
         if duration:
-            self.schedule_unpunish(duration, user, reason)
+            self.scheduler.schedule(timestamp, server.id, user.id)
 
         await self.bot.say(msg)
 
+    @punish.command(pass_context=True, no_pm=True, name='bulk')
+    @checks.mod_or_permissions(manage_messages=True)
+    async def punish_bulk(self, ctx, duration: str, *targets: str):
+        """Punishes many users at once, for raids.
+
+        Targets are any mix of mentions, ids, role mentions and joined=<time>
+        for everyone who joined within that time. Everything after -- is
+        the reason.
+        Example: [p]punish bulk 1h joined=10m @spammer -- Raid"""
+        server = ctx.message.server
+        author = ctx.message.author
+        started = time.time()
+        targets = list(targets)
+        reason = None
+        if '--' in targets:
+            reason = ' '.join(targets[targets.index('--') + 1:]) or None
+            targets = targets[:targets.index('--')]
+        try:
+            until = _parse_until(duration)
+            members, missing = _resolve_targets(server, targets)
+        except ValueError:
+            await send_cmd_help(ctx)
+            return
+
+        role = await self.setup_role(server)
+        if role is None:
+            return
+
+        allowed = [m for m in members if m != server.me and author.top_role > m.top_role]
+        skipped = len(members) - len(allowed)
+        punishments = self.json.setdefault(server.id, {})
+        previous = {m.id: punishments.get(m.id) for m in allowed}
+        keys = []
+        for member in allowed:
+            punishments[member.id] = {'until': until, 'by': author.id, 'reason': reason}
+            keys.append((server.id, member.id))
+        self.journal.punished(*keys)
+
+        async def apply(member):
+            """Returns whether the voice state could be applied too, raises if the role couldn't"""
+            if role not in member.roles:
+                await self.bot.add_roles(member, role)
+            try:
+                if not (member.mute and member.deaf):
+                    await self.bot.server_voice_state(member, mute=True, deafen=True)
+            except discord.DiscordException:
+                return False
+            return True
+
+        results = await asyncio.gather(*[self._limited(server, apply(m)) for m in allowed],
+                                       return_exceptions=True)
+        # Without the role nothing was applied, so the punishment from before the bulk run stands
+        failed = [m for m, r in zip(allowed, results) if isinstance(r, Exception)]
+        unmuted = sum(1 for r in results if r is False)
+        restored = [m for m in failed if previous[m.id] is not None]
+        for member in restored:
+            punishments[member.id] = previous[member.id]
+        for member in failed:
+            if previous[member.id] is None:
+                del(punishments[member.id])
+        self.journal.punished(*[(server.id, m.id) for m in restored])
+        self.journal.unpunished(*[(server.id, m.id) for m in failed if previous[m.id] is None])
+
+        punished = [m for m in allowed if m not in failed]
+        self.history.record('punish', *[(server.id, m.id, author.id, until, reason) for m in punished])
+        if until:
+            self.scheduler.schedule_many([(until, server.id, m.id) for m in punished])
+        else:
+            for member in punished:
+                self.scheduler.cancel(server.id, member.id)
+
+        msg = 'Punished %d member(s), %d failed, %d skipped, %d not found. Took %.2fs.' % (
+            len(punished), len(failed), skipped, missing, time.time() - started)
+        if unmuted:
+            msg += ' Could not mute %d of them in voice.' % unmuted
+        await self.bot.say(msg)
+
+    @punish.command(pass_context=True, no_pm=True, name='history')
+    @checks.mod_or_permissions(manage_messages=True)
+    async def punish_history(self, ctx, user: str, window: str=HISTORY_WINDOW):
+        """Shows how often a user was punished within a time window.
+
+        The user is a mention or an id, so members who left can be looked up.
+        The window defaults to 30 days, use "all" for all time.
+        Example: [p]punish history @idiot 7d"""
+        server = ctx.message.server
+        user_id = user.strip('<@!>')
+        now = time.time()
+        try:
+            if not user_id.isdigit():
+                raise ValueError('Invalid user "%s"' % user)
+            since = None if window.lower() == 'all' else now - _parse_time(window)
+        except ValueError:
+            await send_cmd_help(ctx)
+            return
+
+        names = {None: 'n/a'}
+
+        def getmname(mid):
+            if mid not in names:
+                member = server.get_member(mid)
+                names[mid] = str(member) if member else '(id #%s)' % mid
+            return names[mid]
+
+        counts = self.history.counts(server.id, user_id, since)
+        if not counts:
+            await self.bot.say('%s has no punishment history in that window.' % getmname(user_id))
+            return
+
+        msg = '%s was punished %d time(s)' % (getmname(user_id), counts.get('punish', 0))
+        if counts.get('rejoin'):
+            msg += ', and re-punished %d time(s) for rejoining' % counts['rejoin']
+        msg += '.'
+
+        headers = ['Event', 'When', 'By', 'Duration', 'Reason']
+        table = []
+        for action, at, moderator, until, reason in self.history.recent(server.id, user_id, since):
+            ago = _generate_timespec(now - at) + ' ago' if now - at >= 1 else 'now'
+            if action in ('punish', 'rejoin'):
+                duration = _generate_timespec(until - at) if until and until > at else 'forever'
+            else:
+                duration = ''
+            table.append((action, ago, getmname(moderator), duration, reason or ''))
+        await self.bot.say(msg)
+        for page in pagify(tabulate(table, headers), ['\n']):
+            await self.bot.say(box(page))
+
     @commands.command(pass_context=True, no_pm=True, name='lspunish')
     @checks.mod_or_permissions(manage_messages=True)
-    async def list_punished(self, ctx):
+    async def list_punished(self, ctx, *filters: str):
         """Shows a table of punished users with time, mod and reason.
 
         Displays punished users, time remaining, responsible moderator and
-        the reason for punishment, if any."""
+        the reason for punishment, if any.
+        Filters: by=<moderator> only lists punishments given by that
+        moderator, within=<time> only those ending within that time.
+        Example: [p]lspunish by=@mod within=1h"""
         server = ctx.message.server
         server_id = server.id
+        try:
+            moderator, within = _parse_list_filters(filters)
+        except ValueError:
+            await send_cmd_help(ctx)
+            return
         if not (server_id in self.json and self.json[server_id]):
             await self.bot.say("No users are currently punished.")
             return
 
+        names = {}
+
         def getmname(mid):
-            member = discord.utils.get(server.members, id=mid)
-            if member:
-                if member.nick:
-                    return '%s (%s)' % (member.nick, member)
+            if mid not in names:
+                member = server.get_member(mid)
+                if not member:
+                    names[mid] = '(member not present, id #%s)' % mid
+                elif member.nick:
+                    names[mid] = '%s (%s)' % (member.nick, member)
                 else:
-                    return str(member)
-            else:
-                return '(member not present, id #%d)'
+                    names[mid] = str(member)
+            return names[mid]
 
         headers = ['Member', 'Remaining', 'Punished by', 'Reason']
         table = []
         disp_table = []
         now = time.time()
         for member_id, data in self.json[server_id].items():
-            member_name = getmname(member_id)
-            punisher_name = getmname(data['by'])
-            reason = data['reason']
             t = data['until']
+            if moderator and data['by'] != moderator:
+                continue
+            if within is not None and not (t and t - now <= within):
+                continue
             sort = t if t else float("inf")
-            table.append((sort, member_name, t, punisher_name, reason))
+            table.append((sort, member_id, data))
 
-        for _, name, rem, mod, reason in sorted(table, key=lambda x: x[0]):
+        if not table:
+            await self.bot.say("No punishments match those filters.")
+            return
+
+        table.sort(key=lambda x: x[0])
+        for _, member_id, data in table:
+            rem = data['until']
             remaining = _generate_timespec(rem - now) if rem else 'forever'
-            if not reason:
-                reason = 'n/a'
-            disp_table.append((name, remaining, mod, reason))
+            disp_table.append((getmname(member_id), remaining, getmname(data['by']), data['reason'] or 'n/a'))
 
-        msg = '```\n%s\n```' % tabulate(disp_table, headers)
-        await self.bot.say(msg)
+        msg = tabulate(disp_table, headers)
+        for page in pagify(msg, ['\n']):
+            await self.bot.say(box(page))
 
     @commands.command(pass_context=True, no_pm=True)
     @checks.mod_or_permissions(manage_messages=True)
@@ -262,8 +697,57 @@ class Punish:
         
         
 
+    @commands.group(pass_context=True, no_pm=True)
+    @checks.admin_or_permissions(manage_roles=True)
+    async def punishset(self, ctx):
+        """Punish role settings."""
+        if ctx.invoked_subcommand is None:
+            await send_cmd_help(ctx)
+
+    @punishset.command(pass_context=True, no_pm=True, name='resync')
+    async def punishset_resync(self, ctx):
+        """Repairs the punish role's permissions in every channel.
+
+        Only channels whose permissions for the role differ are changed."""
+        server = ctx.message.server
+        role = self._get_role(server)
+        if not role:
+            await self.bot.say("The %s role doesn't exist yet." % self.role_name)
+            return
+        changed, failed = await self.sync_role_permissions(server, role)
+        msg = 'Done, fixed %d channel(s).' % changed
+        if failed:
+            msg += ' Failed to update %d channel(s), check my permissions.' % failed
+        await self.bot.say(msg)
+
+    def _channel_overwrite(self, channel):
+        """Returns the overwrite the punish role should have in a channel"""
+        perms = discord.PermissionOverwrite()
+        if channel.type == discord.ChannelType.text:
+            perms.send_messages = False
+            perms.send_tts_messages = False
+        elif channel.type == discord.ChannelType.voice:
+            perms.speak = False
+        return perms
+
+    async def sync_role_permissions(self, server, role):
+        """Sets the punish role's overwrite in every channel where it differs.
+
+        Changes are sent concurrently under the server's limiter. Returns the
+        number of channels changed and the number of failures."""
+        changes = []
+        for c in server.channels:
+            if c.is_private:
+                continue
+            perms = self._channel_overwrite(c)
+            if dict(c.overwrites_for(role)) != dict(perms):
+                changes.append(self._limited(server, self.bot.edit_channel_permissions(c, role, overwrite=perms)))
+        results = await asyncio.gather(*changes, return_exceptions=True)
+        failed = sum(1 for r in results if isinstance(r, Exception))
+        return len(changes) - failed, failed
+
     async def setup_role(self, server, quiet=False):
-        role = discord.utils.get(server.roles, name=self.role_name)
+        role = self._get_role(server)
         if not role:
             if not (any(r.permissions.manage_roles for r in server.me.roles) and
                     any(r.permissions.manage_channels for r in server.me.roles)):
@@ -276,10 +760,10 @@ class Punish:
                 log.debug('Creating punish role')
                 perms = discord.Permissions.none()
                 role = await self.bot.create_role(server, name=self.role_name, permissions=perms)
+                self.roles[server.id] = role
                 if not quiet:
                     msgobj = await self.bot.edit_message(msgobj, msgobj.content + 'configuring channels... ')
-                for c in server.channels:
-                    await self.on_channel_create(c, role)
+                await self.sync_role_permissions(server, role)
                 if not quiet:
                     await self.bot.edit_message(msgobj, msgobj.content + 'done.')
         return role
@@ -288,13 +772,14 @@ class Punish:
     @checks.mod_or_permissions(manage_messages=True)
     async def unpunish(self, ctx, user: discord.Member):
         """Removes punishment from a user. Same as removing the role directly"""
-        role = discord.utils.get(user.server.roles, name=self.role_name)
+        role = self._get_role(user.server)
         sid = user.server.id
         if role and role in user.roles:
             reason = 'Punishment manually ended early by %s. ' % ctx.message.author
             if self.json[sid][user.id]['reason']:
                 reason += self.json[sid][user.id]['reason']
             await self._unpunish(user, reason)
+            self.history.record('unpunish', (sid, user.id, ctx.message.author.id, None, None))
             await self.bot.say('Done.')
         else:
             await self.bot.say("That user wasn't punished.")
@@ -302,32 +787,64 @@ class Punish:
     async def on_load(self):
         """Called when bot is ready and each time cog is (re)loaded"""
         await self.bot.wait_until_ready()
+        started = time.time()
+        actions = []
+        expired = []
+        skipped = 0
         # copy so we can delete stuff from the original
         for serverid, members in self.json.copy().items():
-            server = discord.utils.get(self.bot.servers, id=serverid)
+            server = self.bot.get_server(serverid)
             if not server:
                 del(self.json[serverid])
                 continue
-            role = discord.utils.get(server.roles, name=self.role_name)
-            for member_id, data in members.items():
+            role = self._get_role(server)
+            if not role:
+                log.warning('Punish role missing in %s, not restoring punishments' % server.name)
+                continue
+            for member_id, data in members.copy().items():
                 until = data['until']
-                if until:
-                    duration = until - time.time()
-                member = discord.utils.get(server.members, id=member_id)
-                if until and duration < 0:
+                member = server.get_member(member_id)
+                if until and until < started:
                     if member:
                         reason = 'Punishment removal overdue, maybe bot was offline. '
-                        if self.json[server.id][member_id]['reason']:
-                            reason += self.json[server.id][member_id]['reason']
-                        await self._unpunish(member, reason)
+                        if data['reason']:
+                            reason += data['reason']
+                        actions.append(self._limited(server, self._unpunish(member, reason, save=False)))
+                        expired.append((serverid, member_id, None, until, data['reason']))
                     else:  # member disappeared
-                        del(self.json[server.id][member.id])
+                        del(self.json[server.id][member_id])
                 elif member:
-                    await self.bot.add_roles(member, role)
-                    await self.bot.server_voice_state(member, mute=True, deafen=True)
-                    if until:
-                        self.schedule_unpunish(duration, member)
-        dataIO.save_json(self.location, self.json)
+                    if role in member.roles and member.mute and member.deaf:
+                        skipped += 1
+                    else:
+                        actions.append(self._limited(server, self._repunish(member, role)))
+        for result in await asyncio.gather(*actions, return_exceptions=True):
+            if isinstance(result, Exception):
+                log.warning('Failed to restore a punishment: %r' % result)
+        self.journal.compact()
+        self.history.record('expire', *expired)
+        self.scheduler.rebuild(self.json)
+        self.scheduler.start()
+        log.info('Restored punishments in %.2fs: %d actions, %d skipped'
+                 % (time.time() - started, len(actions), skipped))
+
+    def _limiter(self, server):
+        """Returns the semaphore bounding concurrent API calls in a server"""
+        if server.id not in self.limiters:
+            self.limiters[server.id] = asyncio.Semaphore(GUILD_CONCURRENCY)
+        return self.limiters[server.id]
+
+    async def _limited(self, server, coro):
+        """Awaits coro once the server has a free API call slot"""
+        async with self._limiter(server):
+            return await coro
+
+    async def _repunish(self, member, role):
+        """Applies the role and voice state of a punishment, where missing"""
+        if role not in member.roles:
+            await self.bot.add_roles(member, role)
+        if not (member.mute and member.deaf):
+            await self.bot.server_voice_state(member, mute=True, deafen=True)
 
     # Storytime!    
     
@@ -349,12 +866,12 @@ class Punish:
             return
         else:
             users = user.voice_channel.voice_members
-        x = []
-        for member in users:
-            if member != user: 
-                x.append(member)
-        for member in x:
-            await self.bot.server_voice_state(member, mute=True)
+        # members muted already stay out of it, we don't want to unmute them later
+        targets = [m for m in users if m != user and not m.mute]
+        muted = self.storytime_muted.setdefault(server.id, set())
+        results = await self._set_mute(server, targets, True)
+        muted.update(m.id for m, r in zip(targets, results) if not isinstance(r, Exception))
+        self._save_storytime()
 
         # if user.id in self.json[server.id]:
             # msg = 'User was already punished; resetting their timer...'
@@ -392,65 +909,104 @@ class Punish:
     @checks.mod_or_permissions(manage_messages=True)
     @storytime.command(name="end", pass_context=True, no_pm=True)    
     async def storytime_end(self, ctx, user: discord.Member = None):
+        """Unmutes the members storytime muted, in the channel of the user or everywhere"""
         server = ctx.message.server
-        if not user:
-            for channel in server.channels:
-                for member in channel.voice_members:
-                    await self.bot.server_voice_state(member, mute=False)
-            return        
-            
-        if not user.voice_channel:
+        # Servers storytime never tracked, e.g. from before it did, get everyone unmuted
+        tracked = server.id in self.storytime_muted
+        muted = self.storytime_muted.setdefault(server.id, set())
+        if user and not user.voice_channel:
             await self.bot.say('User is not in a voice channel')
             return
+        elif user:
+            members = [m for m in user.voice_channel.voice_members if not tracked or m.id in muted]
+        elif tracked:
+            members = [m for m in map(server.get_member, muted) if m]
         else:
-            users = user.voice_channel.voice_members
-        x = []
-        for member in users: 
-            x.append(member)
-        for member in x:
-            await self.bot.server_voice_state(member, mute=False)
-        
+            members = [m for c in server.channels for m in c.voice_members]
+        punished = self.json.get(server.id, ())
+        targets = [m for m in members if m.id not in punished]
+        results = await self._set_mute(server, targets, False)
+        # members that aren't connected can't be unmuted, keep them for next time
+        muted.difference_update(m.id for m, r in zip(targets, results) if not isinstance(r, Exception))
+        muted.difference_update(m.id for m in members if m.id in punished)
+        muted.intersection_update(m.id for m in server.members)
+        self._save_storytime()
+
+    def _save_storytime(self):
+        dataIO.save_json(STORYTIME_PATH, {sid: sorted(ids) for sid, ids in self.storytime_muted.items()})
+
+    async def _set_mute(self, server, members, mute):
+        """(Un)mutes members concurrently, returning each result or exception"""
+        return await asyncio.gather(*[self._limited(server, self.bot.server_voice_state(m, mute=mute))
+                                      for m in members], return_exceptions=True)
+
     # Functions related to unpunishing
 
-    def schedule_unpunish(self, delay, member, reason=None):
-        """Schedules role removal, canceling and removing existing tasks if present"""
-        handle = self.bot.loop.call_later(delay, self._unpunish_cb, member, reason)
-        sid = member.server.id
-        if sid not in self.handles:
-            self.handles[sid] = {}
-        if member.id in self.handles[sid]:
-            self.handles[sid][member.id].cancel()
-        self.handles[sid][member.id] = handle
-
-    def _unpunish_cb(self, member, reason=None):
-        """Regular function to be used as unpunish callback"""
-        def wrap(member, reason):
-            return self._unpunish(member, reason)
-        self.bot.loop.create_task(wrap(member, reason))
-
-    async def _unpunish(self, member, reason):
-        """Remove punish role, delete record and task handle"""
-        role = discord.utils.get(member.server.roles, name=self.role_name)
+    async def _expire(self, due):
+        """Scheduler callback ending every punishment that is due, as one batch"""
+        ended = []
+        keys = []
+        events = []
+        for sid, member_id in due:
+            data = self.json.get(sid, {}).get(member_id)
+            if data is None:
+                continue
+            server = self.bot.get_server(sid)
+            member = server and server.get_member(member_id)
+            # Data goes first to prevent triggering on_member_update listener
+            del(self.json[sid][member_id])
+            keys.append((sid, member_id))
+            events.append((sid, member_id, None, data['until'], data['reason']))
+            if member:  # otherwise on_member_join would re-punish them
+                ended.append((member, data['reason']))
+        self.journal.unpunished(*keys)
+        self.history.record('expire', *events)
+
+        actions = []
+        for member, reason in ended:
+            role = self._get_role(member.server)
+            if role:
+                actions.append(self._limited(member.server, self._lift(member, role)))
+        for result in await asyncio.gather(*actions, return_exceptions=True):
+            if isinstance(result, Exception):
+                log.warning('Failed to end a punishment: %r' % result)
+        for member, reason in ended:
+            self.bot.loop.create_task(self._notify_ended(member, reason))
+
+    async def _unpunish(self, member, reason, save=True):
+        """Remove punish role, delete record and scheduled expiry"""
+        role = self._get_role(member.server)
         if role:
             # Has to be done first to prevent triggering on_member_update listener
-            self._unpunish_data(member)
-            await self.bot.remove_roles(member, role)
-            await self.bot.server_voice_state(member, mute=False, deafen=False)
-            msg = 'Your punishiment in %s has ended.' % member.server.name
-            if reason:
-                msg += "\nReason was: %s" % reason
-            await self.bot.send_message(member, msg)
-
-    def _unpunish_data(self, member):
-        """Removes punish data entry and cancels any present callback"""
+            self._unpunish_data(member, save)
+            await self._lift(member, role)
+            await self._notify_ended(member, reason)
+
+    async def _lift(self, member, role):
+        """Removes the role and voice state of a punishment"""
+        await self.bot.remove_roles(member, role)
+        await self.bot.server_voice_state(member, mute=False, deafen=False)
+
+    async def _notify_ended(self, member, reason):
+        """Tells a member their punishment has ended, a few at a time"""
+        msg = 'Your punishiment in %s has ended.' % member.server.name
+        if reason:
+            msg += "\nReason was: %s" % reason
+        async with self.dm_limiter:
+            try:
+                await self.bot.send_message(member, msg)
+            except discord.errors.DiscordException:
+                log.debug('Could not notify %s their punishment ended' % member)
+
+    def _unpunish_data(self, member, save=True):
+        """Removes punish data entry and cancels any scheduled expiry"""
         sid = member.server.id
         if sid in self.json and member.id in self.json[sid]:
             del(self.json[member.server.id][member.id])
-            dataIO.save_json(self.location, self.json)
+            if save:
+                self.journal.unpunished((sid, member.id))
 
-        if sid in self.handles and member.id in self.handles[sid]:
-            self.handles[sid][member.id].cancel()
-            del(self.handles[member.server.id][member.id])
+        self.scheduler.cancel(sid, member.id)
 
     # Listeners
 
@@ -458,45 +1014,58 @@ class Punish:
         """Run when new channels are created and set up role permissions"""
         if c.is_private:
             return
-        perms = discord.PermissionOverwrite()
-        if c.type == discord.ChannelType.text:
-            perms.send_messages = False
-            perms.send_tts_messages = False
-        elif c.type == discord.ChannelType.voice:
-            perms.speak = False
         if not role:
-            role = discord.utils.get(c.server.roles, name=self.role_name)
-        await self.bot.edit_channel_permissions(c, role, overwrite=perms)
+            role = self._get_role(c.server)
+        if role:
+            await self.bot.edit_channel_permissions(c, role, overwrite=self._channel_overwrite(c))
+
+    def _get_role(self, server):
+        """Returns the punish role of a server, cached until roles change"""
+        if server.id not in self.roles:
+            self.roles[server.id] = discord.utils.get(server.roles, name=self.role_name)
+        return self.roles[server.id]
+
+    async def on_server_role_create(self, role):
+        if role.name == self.role_name:
+            self.roles.pop(role.server.id, None)
+
+    async def on_server_role_delete(self, role):
+        if role.name == self.role_name:
+            self.roles.pop(role.server.id, None)
+
+    async def on_server_role_update(self, before, after):
+        if self.role_name in (before.name, after.name):
+            self.roles.pop(after.server.id, None)
 
     async def on_member_update(self, before, after):
         """Remove scheduled unpunish when manually removed"""
         sid = before.server.id
-        role = discord.utils.get(before.server.roles, name=self.role_name)
-        if not (sid in self.json and before.id in self.json[sid]):
+        # Fast path for the vast majority of updates, about unpunished members
+        if before.id not in self.json.get(sid, ()):
             return
+        role = self._get_role(before.server)
         if role and role in before.roles and role not in after.roles:
             msg = 'Your punishiment in %s was ended early by a moderator/admin.' % before.server.name
             if self.json[sid][before.id]['reason']:
                 msg += '\nReason was: ' + self.json[sid][before.id]['reason']
             await self.bot.send_message(after, msg)
             self._unpunish_data(after)
+            self.history.record('unpunish', (sid, after.id, None, None, None))
 
     async def on_member_join(self, member):
         """Restore punishment if punished user leaves/rejoins"""
         sid = member.server.id
-        role = discord.utils.get(member.server.roles, name=self.role_name)
+        if member.id not in self.json.get(sid, ()):
+            return
+        role = self._get_role(member.server)
         if role:
-            if not (sid in self.json and member.id in self.json[sid]):
-                return
-            duration = self.json[sid][member.id]['until'] - time.time()
-            if duration > 0:
+            until = self.json[sid][member.id]['until']
+            if not until or until > time.time():
                 await self.bot.add_roles(member, role)
                 await self.bot.server_voice_state(member, mute=True, deafen=True)
-                reason = 'punishment re-added on rejoin. '
-                if self.json[sid][member.id]['reason']:
-                    reason += self.json[sid][member.id]['reason']
-                if member.id not in self.handles[sid]:
-                    self.schedule_unpunish(duration, member, reason)
+                self.history.record('rejoin', (sid, member.id, None, until, self.json[sid][member.id]['reason']))
+                if until and (sid, member.id) not in self.scheduler.deadlines:
+                    self.scheduler.schedule(until, sid, member.id)
 
 
 def compat_load(path):
@@ -522,6 +1091,9 @@ def check_file():
     if dataIO.is_valid_json(f) is False:
         log.debug('Creating json: settings.json')
         dataIO.save_json(f, {})
+    if dataIO.is_valid_json(STORYTIME_PATH) is False:
+        log.debug('Creating json: storytime.json')
+        dataIO.save_json(STORYTIME_PATH, {})
 
 
 def setup(bot):